@@ -29,6 +29,7 @@ import math
 import numpy
 import random
 import time
+import multiprocessing
 
 import cv
 import cv2
@@ -52,7 +53,7 @@ MAX_RADIUS = 30
 colors = [ "lightsalmon", "lightgreen", "lightblue", "red", "green", "blue" ]
 
 
-def autorectify(frame, maxu, verbose):
+def autorectify(frame, maxu, verbose, finetune = "climb", n_samples = 16, jobs = 1):
     """
     Automatically detect lenslets in the given frame with the
     given optics parameters (maxu==maxNormalizedSlope) and return
@@ -61,15 +62,16 @@ def autorectify(frame, maxu, verbose):
     """
     # solution = autorectify_de(frame, maxu)
     start_t = time.asctime()
-    solution = autorectify_cv(frame, maxu, verbose)
+    solution = autorectify_cv(frame, maxu, verbose, finetune, n_samples, jobs)
     if verbose:
         print "start", start_t, "end", time.asctime()
     return solution.to_steps()
 
 
-def autorectify_cv(frame, maxu, verbose):
+def autorectify_cv(frame, maxu, verbose, finetune = "climb", n_samples = 16, jobs = 1):
     """
     Autorectification based on computer vision analysis.
+    The n_samples tiles are sampled by a pool of jobs processes.
     """
     #image = frame.to_numpy_array()
     image = frame
@@ -77,25 +79,31 @@ def autorectify_cv(frame, maxu, verbose):
     tiling = ImageTiling(image, MAX_RADIUS * 5)
     tiling.scan_brightness()
 
-    n_samples = 16
-    tiles = range(n_samples)
-    rps = range(n_samples)
-    for i in range(n_samples):
-      while True:
-       try:
-        (tiles[i], rps[i]) = sample_rp_from_tiling(frame, tiling, maxu, i, verbose)
-
-       except IndexError:
-        # IndexError can be thrown in case one of the areas reaches
-        # to one edge of the tile; try with another tile
-        if verbose:
-            print ">>> bad region, retrying"
-        continue
+    # Every sample draws from its own random generator, seeded from
+    # the global one; the result thus does not depend on which process
+    # takes which sample, and is the same for any number of jobs
+    seeds = numpy.random.randint(0, 2**31 - 1, size = n_samples)
+    global sample_state
+    sample_state = (frame, tiling, maxu, verbose)
+    sample_jobs = [(i, seeds[i]) for i in range(n_samples)]
+    if jobs > 1:
+        # The workers inherit sample_state when forked
+        pool = multiprocessing.Pool(min(jobs, n_samples))
+        try:
+            samples = pool.map(sample_rp_job, sample_jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        samples = map(sample_rp_job, sample_jobs)
+    sample_state = None
 
-       else:
-        break
+    rps = [sample[1] for sample in samples if sample is not None]
+    if not rps:
+        raise RuntimeError("no tile with recognizable lens found")
 
     # Show window with whole image, tile parts highlighted
+    #tiles = [sample[0] for sample in samples if sample is not None]
     #f = plt.figure("whole")
     #imgplot = plt.imshow(image.reshape(image.shape[0], image.shape[1]), cmap = plt.cm.gray)
     #for i in range(n_samples):
@@ -112,12 +120,12 @@ def autorectify_cv(frame, maxu, verbose):
     # Fine-tune central lens position
     lens0 = rp.lens0()
     try:
-        lens0 = finetune_lens_position(image, maxu, rp, lens0,verbose)
+        lens0 = FINETUNE_METHODS[finetune](image, maxu, rp, lens0,verbose)
     except IndexError:
         # This went horrendously wrong. Just retry the whole operation.
         if verbose:
             print "!!! Index error when finetuning lens0; retrying autorectification"
-        return autorectify_cv(frame, maxu, verbose)
+        return autorectify_cv(frame, maxu, verbose, finetune, n_samples, jobs)
     rp.lens0(lens0)
 
     # Incrementally look at and fine-tune more lens in four directions
@@ -141,7 +149,7 @@ def autorectify_cv(frame, maxu, verbose):
             #plt.show()
 
         try:
-            rp = refine_rp_by_lens_finetune(image, maxu, rp, delta, verbose)
+            rp = refine_rp_by_lens_finetune(image, maxu, rp, delta, verbose, finetune)
         except IndexError:
             print "out of bounds, stopping early"
             break
@@ -161,10 +169,37 @@ def swapxy(a):
     """
     return numpy.array([a[1], a[0]])
 
-def sample_rp_from_tiling(frame, tiling, maxu, i, verbose):
-    t = tiling.random_tile()
+# Number of tiles tried for a single sample before giving up on it
+SAMPLE_RETRIES = 32
+
+# (frame, tiling, maxu, verbose) of the samples being taken
+sample_state = None
+
+def sample_rp_job(job):
+    """
+    Take sample i (with the given random seed) of sample_state,
+    retrying with other tiles on failure. Returns None if no tile
+    worked out.
+    """
+    (i, seed) = job
+    (frame, tiling, maxu, verbose) = sample_state
+    rng = numpy.random.RandomState(seed)
+    for retry in range(SAMPLE_RETRIES):
+        try:
+            return sample_rp_from_tiling(frame, tiling, maxu, i, verbose, rng)
+        except IndexError:
+            # IndexError can be thrown in case one of the areas reaches
+            # to one edge of the tile; try with another tile
+            if verbose:
+                print ">>> bad region, retrying"
+    if verbose:
+        print ">>> giving up on sample", i
+    return None
+
+def sample_rp_from_tiling(frame, tiling, maxu, i, verbose, rng = numpy.random):
+    t = tiling.random_tile(rng)
     s = tiling.tile_step
-    perturb = [numpy.random.randint(-s/4, s/4), numpy.random.randint(-s/4, s/4)]
+    perturb = [rng.randint(-s/4, s/4), rng.randint(-s/4, s/4)]
     (ul, br) = tiling.tile_to_imgxy(t, perturb)
     if verbose:
         print tiling.image.shape, "t", t, "p", perturb, "ul", ul, "br", br
@@ -191,7 +226,7 @@ def sample_rp_from_tiling(frame, tiling, maxu, i, verbose):
     #plt.show()
 
     # Identify a lens grid hole
-    holepos = timage.find_any_region(0)
+    holepos = timage.find_any_region(0, rng)
     holec = timage.find_region_center(0, holepos)
 
     # Build 3x3 hole matrix
@@ -235,7 +270,7 @@ def sample_rp_from_tiling(frame, tiling, maxu, i, verbose):
                                               lensmatrix[1,1] - lensmatrix[0,1]], 0)))
     if verbose:
         print "o", lensletOffset, "h", lensletHoriz, "v", lensletVert
-    rp.from_steps((lensletOffset, lensletHoriz, lensletVert), verbose)
+    rp.from_steps((lensletOffset, lensletHoriz, lensletVert), verbose, rng)
     if verbose:
         print "###", rp
 
@@ -254,14 +289,19 @@ def finetune_lens_position(image, maxu, rp, lens0,verbose):
             raise IndexError
 
         shiftmatrix2 = numpy.zeros(tuple(matrixshape))
+        measured = []
         for y in range(-matrixsize, matrixsize+1):
             for x in range(-matrixsize, matrixsize+1):
                 c2 = matrixcenter + [y, x]
                 c1 = c2 + gradient
                 if (c1 < [0,0]).any() or (c1 >= matrixshape).any():
-                    shiftmatrix2[tuple(c2)] = measure_rectification_one(image, maxu, rp, lens0 + [y, x])
+                    measured.append(c2)
                 else:
                     shiftmatrix2[tuple(c2)] = shiftmatrix[tuple(c1)]
+        # Measure all the new candidate positions at once
+        values = measure_rectification_many(image, maxu, rp, [lens0 + c - matrixcenter for c in measured])
+        for (c2, value) in zip(measured, values):
+            shiftmatrix2[tuple(c2)] = value
         shiftmatrix = shiftmatrix2
 
         gradient = numpy.array(numpy.unravel_index(shiftmatrix.argmax(), tuple(matrixshape))) - matrixcenter
@@ -277,12 +317,71 @@ def finetune_lens_position(image, maxu, rp, lens0,verbose):
 
     return lens0
 
-def refine_rp_by_lens_finetune(image, maxu, rp, delta, verbose):
+def finetune_lens_position_corr(image, maxu, rp, lens0, verbose):
+    """
+    Like finetune_lens_position(), but find the best lens position
+    within half a lens of lens0 at once: the in-lens and out-lens
+    sums of all the candidate positions are computed by correlating
+    the image with the lens kernels, and the peak of their ratio
+    is interpolated to sub-pixel precision.
+    """
+    if lens0[0] < 0 or lens0[1] < 0 or lens0[0] >= image.shape[0] or lens0[1] >= image.shape[1]:
+        raise IndexError
+
+    (kernelIn, kernelOut) = rp.lens_kernels(maxu)
+    r = kernelIn.shape[0] // 2
+    radius = max(1, int(round(min(rp.size) / 2)))
+
+    # Image region under all the candidate lens, zero outside of the canvas
+    (x0, y0) = numpy.round(lens0).astype(int)
+    margin = radius + r
+    region = numpy.zeros((2 * margin + 1, 2 * margin + 1))
+    (height, width) = image.shape[:2]
+    (top, left) = (max(0, y0 - margin), max(0, x0 - margin))
+    (bottom, right) = (min(height, y0 + margin + 1), min(width, x0 + margin + 1))
+    pixels = image[top:bottom, left:right]
+    if pixels.ndim > 2:
+        pixels = pixels.sum(axis = 2)
+    region[top - (y0 - margin):bottom - (y0 - margin), left - (x0 - margin):right - (x0 - margin)] = pixels
+
+    # cv2.filter2D() correlates (rather than convolves), using the DFT
+    # for large kernels
+    valueIn = cv2.filter2D(region, -1, kernelIn, anchor = (r, r), borderType = cv2.BORDER_CONSTANT)
+    valueOut = cv2.filter2D(region, -1, kernelOut, anchor = (r, r), borderType = cv2.BORDER_CONSTANT)
+    eps = numpy.finfo(numpy.float).eps
+    response = ((valueIn + eps) / (valueOut + eps))[r:r + 2 * radius + 1, r:r + 2 * radius + 1]
+
+    (py, px) = numpy.unravel_index(response.argmax(), response.shape)
+    peak = numpy.array([subpixel_peak(response[py, :], px), subpixel_peak(response[:, px], py)])
+    if verbose:
+        print "lens0", lens0, "response peak", peak - radius
+    return numpy.array([x0, y0]) + peak - radius
+
+def subpixel_peak(values, i):
+    """
+    Interpolate the position of the maximum values[i] by fitting
+    a parabola through it and its two neighbors.
+    """
+    if i == 0 or i == len(values) - 1:
+        return float(i)
+    denominator = values[i-1] - 2 * values[i] + values[i+1]
+    if denominator >= 0:
+        return float(i)
+    return i + 0.5 * (values[i-1] - values[i+1]) / denominator
+
+# Lens position fine-tuning methods: hill climbing by single pixel steps,
+# or correlation with the lens kernels
+FINETUNE_METHODS = {
+    "climb": finetune_lens_position,
+    "correlate": finetune_lens_position_corr,
+}
+
+def refine_rp_by_lens_finetune(image, maxu, rp, delta, verbose, finetune = "climb"):
     dirs = numpy.array([[1,0], [-1,0], [0,1], [0,-1]]) * delta
 
     (lensletOffset, lensletHoriz, lensletVert) = rp.to_steps()
     lens_before = [rp.xylens(d) for d in dirs]
-    lens_after = [finetune_lens_position(image, maxu, rp, l.copy(), verbose) for l in lens_before]
+    lens_after = [FINETUNE_METHODS[finetune](image, maxu, rp, l.copy(), verbose) for l in lens_before]
     if verbose:
         print "  before", lens_before
         print "  after ", lens_after
@@ -336,13 +435,13 @@ class TileImage:
         self.image = cv2.medianBlur(self.image, 3);
         return self
 
-    def find_any_region(self, color):
+    def find_any_region(self, color, rng = numpy.random):
         c = numpy.array([self.tiling.tile_step / 2, self.tiling.tile_step / 2])
         step = 5
         while self.image[tuple(c)] != color:
             # Random walk over the neighborhood
-            c[0] += int(step*2 * numpy.random.random_sample() - step)
-            c[1] += int(step*2 * numpy.random.random_sample() - step)
+            c[0] += int(step*2 * rng.random_sample() - step)
+            c[1] += int(step*2 * rng.random_sample() - step)
             # print c, " -> ", self.image[tuple(c)]
         return c
 
@@ -498,59 +597,51 @@ def measure_rectification(image, tiling, maxu, rparams):
     n_samples = int(10 + round(gridsize[0] * gridsize[1] / 400))
     # print "  measuring ", rparams, " with grid ", gridsize, " and " ,n_samples ," samples"
 
-    value = 0.
-
-    # TODO: Draw all samples at once
-    for i in range(n_samples):
-        t = tiling.random_tile()
+    lenspositions = []
+    for t in tiling.random_tiles(n_samples):
         s = tiling.tile_to_lens(t, rparams)
         # print "tile ", t, "lens ", s
-        value += measure_rectification_one(image, maxu, rparams, rparams.xylens(s))
+        lenspositions.append(rparams.xylens(s))
 
-    return value / n_samples
+    return measure_rectification_many(image, maxu, rparams, lenspositions).sum() / n_samples
 
 
 def measure_rectification_one(image, maxu, rparams, lenspos):
     """
     Measure rectification of a single given lens.
     """
-    lenssize = rparams.size * maxu
-
-    # print "measuring (", lenspos, " - ", lenssize, ") with ", rparams
-
-    value_inlens = 0.
-    value_outlens = 0.
-
-    for x in range(int(round(-rparams.size[0]/2)), int(round(rparams.size[0]/2))):
-        for y in range(int(round(-rparams.size[1]/2)), int(round(rparams.size[1]/2))):
-            # XXX: we could tilt the whole coordinate grid at once
-            # (or actually the source image subspace) to speed things up
-            inLensPos = rparams.xytilted([x, y])
-
-            imgpos = lenspos + inLensPos
-            # XXX: subpixel sampling?
-            imgpos = imgpos.round()
-
-            # print " ", [x, y], " in lens ", rparams, " is ", inLensPos, ", in-img is ", imgpos
-
-            try:
-                # sum() is not terribly good pixval, TODO maybe calculate
-                # actual brightness?
-                pixval = sum(image[int(imgpos[1])][int(imgpos[0])])
-            except IndexError:
-                # Do not include out-of-canvas pixels in the computation.
-                # Therefore, out-of-canvas tiles will have both inlens
-                # and outlens values left at zero.
-                # print "index error for ", lenspos, " -> ", imgpos
-                continue
-
-            # Are we in the ellipsis defined by lenssize?
-            if ((inLensPos / lenssize) ** 2).sum() <= 1.:
-                # print " IN LENS pixval ", pixval, " for ", lenspos, " -> ", imgpos
-                value_inlens += pixval
-            else:
-                # print "OUT LENS pixval ", pixval, " for ", lenspos, " -> ", imgpos
-                value_outlens += pixval
+    return measure_rectification_many(image, maxu, rparams, [lenspos])[0]
+
+
+def measure_rectification_many(image, maxu, rparams, lenspositions):
+    """
+    Measure rectification of each of the given lens positions,
+    returning a numpy array of the values. All pixels of all the
+    lens are gathered from the image at once.
+    """
+    (inLensPos, inLens) = rparams.lens_template(maxu)
+
+    # Image coordinates [lens, pixel, xy]
+    # XXX: subpixel sampling?
+    imgpos = (numpy.asarray(lenspositions, dtype = float).reshape(-1, 1, 2) + inLensPos).round()
+    ix = imgpos[:, :, 0].astype(int)
+    iy = imgpos[:, :, 1].astype(int)
+
+    # Do not include out-of-canvas pixels in the computation.
+    # Therefore, out-of-canvas tiles will have both inlens
+    # and outlens values left at zero. (Like in plain indexing,
+    # negative coordinates wrap around.)
+    (height, width) = image.shape[:2]
+    valid = (iy >= -height) & (iy < height) & (ix >= -width) & (ix < width)
+    pixval = image[numpy.where(valid, iy, 0), numpy.where(valid, ix, 0)].astype(float)
+    # sum() is not terribly good pixval, TODO maybe calculate
+    # actual brightness?
+    if pixval.ndim > 2:
+        pixval = pixval.sum(axis = 2)
+    pixval[~valid] = 0.
+
+    value_inlens = pixval[:, inLens].sum(axis = 1)
+    value_outlens = pixval[:, ~inLens].sum(axis = 1)
 
     # Just avoid division by zero
     eps = numpy.finfo(numpy.float).eps
@@ -612,6 +703,45 @@ class RectifyParams:
         """
         return self.xytilted_tau(ic, self.tau)
 
+    def lens_template(self, maxu):
+        """
+        Return a tuple (inLensPos, inLens) describing the pixels of
+        a single lens: inLensPos[pixel] are their tilted offsets from
+        the lens center, inLens[pixel] is True for the pixels within
+        the ellipse defined by lens size * maxu. Computed once for
+        the current size and tilt.
+        """
+        key = (tuple(self.size), self.tau, maxu)
+        if getattr(self, 'template_key', None) != key:
+            (x, y) = numpy.mgrid[int(round(-self.size[0]/2)):int(round(self.size[0]/2)),
+                                 int(round(-self.size[1]/2)):int(round(self.size[1]/2))]
+            inLensPos = self.xytilted([x.ravel(), y.ravel()]).T
+            lenssize = self.size * maxu
+            inLens = ((inLensPos / lenssize) ** 2).sum(axis = 1) <= 1.
+            self.template = (inLensPos, inLens)
+            self.template_key = key
+            self.kernels = None
+        return self.template
+
+    def lens_kernels(self, maxu):
+        """
+        Return a tuple (kernelIn, kernelOut) of correlation kernels
+        that sum up the in-lens and out-lens pixels of lens_template()
+        around their anchor at the kernel center. Computed once for
+        the current size and tilt.
+        """
+        (inLensPos, inLens) = self.lens_template(maxu)
+        if self.kernels is None:
+            offsets = inLensPos.round().astype(int)
+            r = numpy.abs(offsets).max()
+            ksize = 2 * r + 1
+            indices = (offsets[:, 1] + r) * ksize + (offsets[:, 0] + r)
+            kernelIn = numpy.bincount(indices[inLens], minlength = ksize * ksize)
+            kernelOut = numpy.bincount(indices[~inLens], minlength = ksize * ksize)
+            self.kernels = (kernelIn.reshape(ksize, ksize).astype(float),
+                            kernelOut.reshape(ksize, ksize).astype(float))
+        return self.kernels
+
     def xylens(self, gc):
         """
         Return image coordinates of a lens at given grid coordinates.
@@ -632,7 +762,7 @@ class RectifyParams:
         straight_pos = self.xytilted_tau(tilted_pos, -self.tau)
         return (straight_pos / self.size).astype(int)
 
-    def normalize(self):
+    def normalize(self, rng = numpy.random):
         """
         Normalize parameters so that the offset is by less than
         one lens size (i.e. 0 +- size/2) and tau is less than pi/8.
@@ -643,11 +773,11 @@ class RectifyParams:
         # reset randomly so that our specimen do not cluster
         # around maxsize aimlessly.
         if self.size[0] > self.maxsize:
-            self.size[0] = self.minsize + numpy.random.random_sample() * (self.maxsize - self.minsize)
+            self.size[0] = self.minsize + rng.random_sample() * (self.maxsize - self.minsize)
         elif self.size[0] < self.minsize:
             self.size[0] = self.minsize
         if self.size[1] > self.maxsize:
-            self.size[1] = self.size[0] * (0.8 + numpy.random.random_sample() * 0.4)
+            self.size[1] = self.size[0] * (0.8 + rng.random_sample() * 0.4)
         elif self.size[1] < self.minsize:
             self.size[1] = self.minsize
 
@@ -670,7 +800,7 @@ class RectifyParams:
         lensletVert = self.xytilted([0, self.size[1]])
         return (lensletOffset.tolist(), lensletHoriz.tolist(), lensletVert.tolist())
 
-    def from_steps(self, steps, verbose):
+    def from_steps(self, steps, verbose, rng = numpy.random):
         """
         Load parameters from a tuple of
         (lensletOffset, lensletHoriz, lensletVert).
@@ -692,7 +822,7 @@ class RectifyParams:
 
         # normalize() seems to do things with .offset that are not proper
         #self.tau = self.tau % (math.pi/8)
-        self.normalize()
+        self.normalize(rng)
 
         # Whew!
         return self
@@ -804,6 +934,9 @@ class ImageTiling:
                                     for x in range(self.tile_step/2, self.width, self.tile_step)]
                                    for y in range(self.tile_step/2, self.height, self.tile_step)])
         tilecdists = numpy.sqrt(numpy.sum((tilecenters - [self.height / 2, self.width / 2]) ** 2, 2))
+        # with an odd number of tiles, the central tile sits right at
+        # the image center; keep its weight finite
+        tilecdists = numpy.maximum(tilecdists, self.tile_step / 2.)
 
         # construct probability distribution such that
         # xavg 0.5 has highest probability
@@ -816,7 +949,9 @@ class ImageTiling:
         # TODO: Nicer distribution shape?
         #self.pdtiles = (0.5*0.5*0.5 - numpy.power(0.5 - brightxavgtiles, 3)) / numpy.sqrt(tilecdists)
         self.pdtiles = numpy.power(brightstdtiles, 3) / numpy.sqrt(tilecdists)
-        self.pdtiles_sum = self.pdtiles.sum()
+        # Cumulative distribution for drawing tiles, running over the tiles
+        # column by column
+        self.cdtiles = numpy.cumsum(self.pdtiles.T.ravel())
 
         #for t in numpy.mgrid[0:self.height_t, 0:self.width_t].T.reshape(self.height_t * self.width_t, 2):
         #    # t = [y,x] tile index
@@ -824,23 +959,29 @@ class ImageTiling:
 
         return self
 
-    def random_tile(self):
+    def random_tile(self, rng = numpy.random):
         """
         Choose a random tile with regards to the brightness distribution
         among tiles (as pre-processed by scan_brightness().
         """
+        return self.random_tiles(1, rng)[0]
 
-        stab = numpy.random.random_sample() * self.pdtiles_sum
-        for t in numpy.mgrid[0:self.height_t, 0:self.width_t].T.reshape(self.height_t * self.width_t, 2):
-            # t = [y,x] tile index
-            prob = self.pdtiles[t[0], t[1]]
-            if prob > stab:
-                return numpy.array([t[1], t[0]])
-            stab -= prob
-        # We reach here only in case of float arithmetic imprecisions;
-        # just pick a uniformly random tile
-        #print "ImageTiling.random_tile(): fallback to random (warning)"
-        return numpy.array([numpy.random.randint(self.height_t), numpy.random.randint(self.width_t)])
+    def random_tiles(self, n, rng = numpy.random):
+        """
+        Choose n random tiles at once, like n calls of random_tile();
+        returns an array of n tiles. Every tile is found by bisecting
+        the cumulative distribution computed by scan_brightness().
+        """
+        if not (self.cdtiles[-1] > 0 and numpy.isfinite(self.cdtiles[-1])):
+            # degenerate distribution; just pick uniformly random tiles
+            #print "ImageTiling.random_tiles(): fallback to random (warning)"
+            return numpy.array([rng.randint(self.width_t, size = n), rng.randint(self.height_t, size = n)]).T
+        stabs = rng.random_sample(n) * self.cdtiles[-1]
+        k = numpy.searchsorted(self.cdtiles, stabs, side = 'right')
+        # stabs at the very end may land past the last tile
+        k = numpy.minimum(k, len(self.cdtiles) - 1)
+        # cdtiles runs over the tiles column by column; tile = [x,y]
+        return numpy.array([k // self.height_t, k % self.height_t]).T
 
     def tile_to_imgxy(self, tile, perturb=[0,0]):
         """
@@ -905,6 +1046,68 @@ class ImageTiling:
         #print "???"
         return 0.5 # unf, what else to do?
 
+# Ways of combining the estimates of several frames
+AGGREGATE_METHODS = ("median", "trimmed")
+# Fraction of the estimates cut off at either end by the trimmed mean
+TRIM_FRACTION = 0.2
+# Number of frames whose estimates must agree for an early stop
+AGREEING_FRAMES = 3
+
+def autorectify_frame(job):
+    """
+    Autorectify a single frame in a worker process. The random
+    generator is seeded for every frame, so the result does not
+    depend on the process.
+    """
+    (frame, seed, maxu, verbose, finetune, n_samples, jobs) = job
+    numpy.random.seed(seed)
+    return autorectify(frame, maxu, verbose, finetune, n_samples, jobs)
+
+def combine_estimates(values, method):
+    """
+    Combine values along the first axis by their median or their
+    mean with TRIM_FRACTION cut off at either end.
+    """
+    if method == "median":
+        return numpy.median(values, axis = 0)
+    values = numpy.sort(values, axis = 0)
+    trim = int(len(values) * TRIM_FRACTION)
+    return values[trim:len(values) - trim].mean(axis = 0)
+
+def align_estimates(estimates, method):
+    """
+    Return the (lensletOffset, lensletHoriz, lensletVert) estimates
+    of several frames as an array, with every lensletOffset moved
+    by whole grid steps to the lens nearest to the lensletOffset
+    of the first estimate. Each frame finds the lens its random tile
+    happened to fall on, so the offsets are comparable only then.
+    The grid steps are the combined steps of all estimates.
+    """
+    estimates = numpy.array(estimates, dtype = float)
+    (horiz, vert) = combine_estimates(estimates[:, 1:], method)
+    basis = numpy.array([horiz, vert]).T
+    offsets = estimates[:, 0]
+    steps = numpy.round(numpy.linalg.solve(basis, (offsets - offsets[0]).T))
+    estimates[:, 0] = offsets - numpy.dot(basis, steps).T
+    return estimates
+
+def aggregate_rectifications(estimates, method):
+    """
+    Combine the (lensletOffset, lensletHoriz, lensletVert) estimates
+    of several frames component by component, after aligning their
+    offsets with align_estimates().
+    """
+    return combine_estimates(align_estimates(estimates, method), method)
+
+def estimates_agree(estimates, method, tolerance):
+    """
+    Whether at least AGREEING_FRAMES estimates, aligned with
+    align_estimates(), are all within tolerance of their aggregate.
+    """
+    aligned = align_estimates(estimates, method)
+    deviations = numpy.abs(aligned - combine_estimates(aligned, method))
+    return (deviations.reshape(len(estimates), -1).max(axis = 1) <= tolerance).sum() >= AGREEING_FRAMES
+
 #This is the command line stuff
 #Output format:
 #(1710.000000,1148.000000,20.000000,0.000000,0.000000,20.000000)
@@ -926,7 +1129,19 @@ if __name__ == '__main__':
     parser.add_argument('-p',
         '--percent',
         help="""The percentage of images to be processed for a sample in a multi image dataset""",
-        nargs=1)
+        type=float)
+    parser.add_argument(
+        '-a',
+        '--aggregate',
+        help="How the estimates of several frames are combined (default: median)",
+        choices=AGGREGATE_METHODS,
+        default="median")
+    parser.add_argument(
+        '-t',
+        '--tolerance',
+        help="Stop once the estimates of several frames agree within this many pixels, 0 to process all frames (default: 0.5)",
+        type=float,
+        default=0.5)
     parser.add_argument(
         '-o',
         '--output',
@@ -941,12 +1156,30 @@ if __name__ == '__main__':
         '-r',
         '--randomseed',
         help="Random generator seed (for reproducible autorectification runs)",
-        nargs=1)
+        type=int)
     parser.add_argument(
         '-u',
         '--maxu',
         help="Maximum tangens of the lens viewing angle",
         nargs=1)
+    parser.add_argument(
+        '-f',
+        '--finetune',
+        help="Lens position fine-tuning method: hill climbing (default) or correlation with a lens template",
+        choices=sorted(FINETUNE_METHODS),
+        default="climb")
+    parser.add_argument(
+        '-s',
+        '--samples',
+        help="Number of tiles sampled for the initial lens grid estimate (default: 16)",
+        type=int,
+        default=16)
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help="Number of frames autorectified, or with a single frame, tiles sampled concurrently (default: 1)",
+        type=int,
+        default=1)
 
     args = parser.parse_args()
     if args.verbose:
@@ -954,8 +1187,11 @@ if __name__ == '__main__':
     else:
         verboseMode = False
 
+    if args.samples < 1 or args.jobs < 1:
+        sys.exit("The number of samples and jobs must be at least 1.")
     if args.randomseed is not None:
         numpy.random.seed(args.randomseed)
+        random.seed(args.randomseed)
 
     inputPlace = args.input
     #check that input file exists, and is a valid HDF5 file
@@ -974,14 +1210,16 @@ if __name__ == '__main__':
         imageGroup = f.require_group("images")
     except TypeError:
         sys.exit("No 'images' group found, which must exist for the file to be processed correctly. Exiting...")
-    numberImages = len(imageGroup)
+    frameNames = sorted(imageGroup.keys(), key = int)
+    numberImages = len(frameNames)
     numberOfImagesToProcess = 1
     if args.percent != None:
-        if args.percent > 0 and args.percent < 100:
-            numberOfImagesToProcess = math.ceil((float(args.percent)/100)*float(numberOfImagesToProcess))
+        if args.percent > 0 and args.percent <= 100:
+            numberOfImagesToProcess = int(math.ceil(args.percent / 100. * numberImages))
         else:
             sys.exit("Invalid percentage given. Exiting...")
-    framesToProcess = random.sample(range(numberImages),numberOfImagesToProcess)
+    framesToProcess = random.sample(frameNames, numberOfImagesToProcess)
+    frameSeeds = dict(zip(framesToProcess, numpy.random.randint(0, 2**31 - 1, size = numberOfImagesToProcess)))
 
     #get maxu
     if args.maxu != None:
@@ -990,20 +1228,51 @@ if __name__ == '__main__':
     else:
         (maxu, maxu_explicit) = hdf5lflib.compute_maxu(imageGroup)
 
-    rectification = ([0,0],[0,0],[0,0])
-    for currentFrameIndex in framesToProcess:
-        currentFrame = imageGroup[str(currentFrameIndex)].value
+    #with several frames, the jobs autorectify whole frames concurrently
+    #(sampling their tiles serially), otherwise they sample the tiles
+    if args.jobs > 1 and numberOfImagesToProcess > 1:
+        batchSize = min(args.jobs, numberOfImagesToProcess)
+        pool = multiprocessing.Pool(batchSize)
+        sampleJobs = 1
+    else:
+        batchSize = 1
+        pool = None
+        sampleJobs = args.jobs
+
+    def readFrame(node):
+        currentFrame = node.value
         currentFrame.shape = (currentFrame.shape[0], currentFrame.shape[1], 1)
-        currentFrame = numpy.swapaxes(currentFrame,0,1)
-        returnTuple = autorectify(currentFrame,maxu,verboseMode)
-        print returnTuple
-        for x in range(0,3):
-            for y in range(0,2):
-                rectification[x][y] += float(returnTuple[x][y])
-    #divide by number of frames processed
-    for x in range(0,3):
-        for y in range(0,2):
-            rectification[x][y] /= float(numberOfImagesToProcess)
+        return numpy.swapaxes(currentFrame,0,1)
+
+    #the next frames are read and decompressed while autorectifying
+    frames = [(name, imageGroup[name]) for name in framesToProcess]
+    estimates = []
+    batch = []
+    for (name, currentFrame) in hdf5lflib.prefetch_frames(frames, readFrame, batchSize):
+        batch.append((currentFrame, frameSeeds[name], maxu, verboseMode, args.finetune, args.samples, sampleJobs))
+        if len(batch) < batchSize and len(estimates) + len(batch) < numberOfImagesToProcess:
+            continue
+        if pool is not None:
+            results = pool.map(autorectify_frame, batch)
+        else:
+            results = map(autorectify_frame, batch)
+        batch = []
+        #check for agreement after every frame in order, so that the
+        #frames used do not depend on the number of jobs
+        for returnTuple in results:
+            print returnTuple
+            estimates.append(returnTuple)
+            if args.tolerance > 0 and estimates_agree(estimates, args.aggregate, args.tolerance):
+                break
+        else:
+            continue
+        print "Estimates of", AGREEING_FRAMES, "frames agree after", len(estimates), "frames"
+        break
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+    rectification = aggregate_rectifications(estimates, args.aggregate).tolist()
 
     #print out here
     x_offset = rectification[0][0]
@@ -0,0 +1,41 @@
+import imp
+import os
+import unittest
+
+import numpy
+
+autorectify = imp.load_source('autorectify',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autorectify-independent.py'))
+
+
+class RandomTilesTest(unittest.TestCase):
+    def tiling(self, height_t, width_t, tile_step = 8):
+        image = numpy.random.RandomState(0).rand(height_t * tile_step, width_t * tile_step, 1)
+        return autorectify.ImageTiling(image, tile_step).scan_brightness()
+
+    def check_tiles(self, tiling, tiles):
+        # tile = [x,y]
+        self.assertTrue((tiles >= 0).all())
+        self.assertTrue((tiles[:, 0] < tiling.width_t).all())
+        self.assertTrue((tiles[:, 1] < tiling.height_t).all())
+        # the draws are spread over most of the tiles
+        self.assertGreater(len(set(map(tuple, tiles))), tiling.width_t * tiling.height_t / 2)
+
+    def test_odd_grid(self):
+        # the central tile lies right at the image center
+        tiling = self.tiling(17, 15)
+        self.assertTrue(numpy.isfinite(tiling.cdtiles[-1]))
+        self.check_tiles(tiling, tiling.random_tiles(3000, numpy.random.RandomState(1)))
+
+    def test_even_grid(self):
+        tiling = self.tiling(16, 14)
+        self.check_tiles(tiling, tiling.random_tiles(3000, numpy.random.RandomState(1)))
+
+    def test_degenerate_distribution(self):
+        tiling = self.tiling(17, 15)
+        tiling.cdtiles[:] = numpy.inf
+        self.check_tiles(tiling, tiling.random_tiles(3000, numpy.random.RandomState(1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
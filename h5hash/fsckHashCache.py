@@ -0,0 +1,182 @@
+import h5hash
+import h5cache
+import h5cacheindex
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+#REQUIRES: A cache directory created by generateHashCache.py
+#MODIFIES: Moves corrupted cache objects to the quarantine directory and,
+#          with -r, places good copies from the source files in the cache
+#EFFECTS: Verifies that every cache object hashes to its name
+
+
+# USAGE
+# ./fsckHashCache.py [-j JOBS] [-t MBPS] [-M METHOD] [-r] [-p PLACEMENT] [-v] [cacheDirectoryPath]
+#
+# Every object of every hash method namespace in the cache (or only of
+# METHOD, e.g. -M sha1:legacy) is rehashed by a pool of JOBS worker
+# processes. Objects that do not hash to their name, or cannot be read at
+# all, are moved to [cacheDirectoryPath]/quarantine/. Hashes recorded in
+# the index whose objects are missing are reported as well.
+#
+# With -r, bad and missing objects are repopulated from the source files
+# recorded in the index: a source whose data still hashes to the expected
+# value is placed in the cache again (see generateHashCache.py for -p).
+#
+# -t limits the total read rate of the workers to MBPS megabytes per
+# second, so that the check can run alongside production jobs.
+
+
+def checkObject(job):
+	#runs in the worker processes; returns (hash, path, method, actual hash, leaves, size)
+	(hashValue, path, method, rate) = job
+	(mode, flavor, algorithm) = h5hash.parseMethod(method)
+	start = time.time()
+	size = os.path.getsize(path)
+	try:
+		currentFile = h5hash.H5HashFile(path, mode, flavor, 1, algorithm)
+		actualHashValue = currentFile.process()
+		leaves = currentFile.leaves
+	except Exception as e:
+		actualHashValue = "unreadable (" + str(e) + ")"
+		leaves = None
+	if rate is not None:
+		#sleep off the time reading at the throttled rate would have taken
+		time.sleep(max(0., float(size) / rate - (time.time() - start)))
+	return (hashValue, path, method, actualHashValue, leaves, size)
+
+def quarantine(cacheDirectoryName, hashValue, path, method):
+	destination = h5cache.quarantinePath(cacheDirectoryName, hashValue, method)
+	if not os.path.isdir(os.path.dirname(destination)):
+		os.makedirs(os.path.dirname(destination))
+	os.rename(path, destination)
+	return destination
+
+def repair(cacheDirectoryName, index, hashValue, method, placement):
+	#places a source file with the expected hash in the cache; returns
+	#the source used, or None if no source hashes to hashValue anymore
+	(mode, flavor, algorithm) = h5hash.parseMethod(method)
+	destination = h5cache.cachePath(cacheDirectoryName, hashValue, method)
+	for (source, size, mtime, inode) in index.sources(hashValue, method):
+		if not os.path.isfile(source):
+			continue
+		if h5hash.H5HashFile(source, mode, flavor, 1, algorithm).process() != hashValue:
+			continue
+		if not os.path.isdir(os.path.dirname(destination)):
+			os.makedirs(os.path.dirname(destination))
+		h5cache.placeFile(source, destination, placement)
+		return source
+	return None
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		prog='fsckHashCache.py',
+		description='Verifies and repairs an HDF5 hash cache directory')
+	parser.add_argument("cache", type=str,
+		help="""The cache directory.""")
+	parser.add_argument('-M',
+		'--method',
+		help="""Only check objects of this hash method, e.g. sha1:legacy""")
+	parser.add_argument('-j',
+		'--jobs',
+		help="""Number of objects checked concurrently (default: 1)""",
+		type=int,
+		default=1)
+	parser.add_argument('-t',
+		'--throttle',
+		help="""Limit the total read rate to this many MB/s""",
+		type=float)
+	parser.add_argument('-r',
+		'--repair',
+		help="""Repopulate bad and missing objects from their source files""",
+		action="store_true")
+	parser.add_argument('-p',
+		'--placement',
+		help="""How repaired objects are placed in the cache (default: copy)""",
+		choices=h5cache.PLACEMENTS,
+		default="copy")
+	parser.add_argument('-v',
+		'--verbose',
+		help="""Print every object checked""",
+		action="store_true")
+	args = parser.parse_args()
+
+	cacheDirectoryName = os.path.normpath(args.cache) + os.sep
+	if not os.path.isdir(cacheDirectoryName):
+		sys.exit("Cache path given is not a directory.")
+	if args.jobs < 1:
+		sys.exit("The number of jobs must be at least 1.")
+	if args.method is not None:
+		try:
+			h5hash.parseMethod(args.method)
+		except ValueError:
+			parser.error("invalid hash method " + args.method)
+		methods = [args.method]
+	else:
+		methods = h5cache.listMethods(cacheDirectoryName)
+	if args.throttle is not None:
+		rate = args.throttle * (1 << 20) / args.jobs
+	else:
+		rate = None
+
+	index = h5cacheindex.CacheIndex(cacheDirectoryName)
+	jobs = []
+	bad = []
+	for method in methods:
+		objects = list(h5cache.listObjects(cacheDirectoryName, method))
+		print "Checking " + str(len(objects)) + " " + method + " objects"
+		jobs.extend((hashValue, path, method, rate) for (hashValue, path) in objects)
+		present = set(hashValue for (hashValue, path) in objects)
+		for hashValue in sorted(index.hashes(method) - present):
+			print "MISSING " + method + " " + hashValue
+			bad.append((hashValue, method))
+
+	if args.jobs > 1:
+		pool = multiprocessing.Pool(args.jobs)
+		results = pool.imap_unordered(checkObject, jobs)
+	else:
+		pool = None
+		results = itertools.imap(checkObject, jobs)
+
+	start = time.time()
+	totalSize = 0
+	for (hashValue, path, method, actualHashValue, leaves, size) in results:
+		totalSize += size
+		if actualHashValue == hashValue:
+			if args.verbose:
+				print "OK " + path
+			continue
+		print "MISMATCH " + path + " hashes to " + actualHashValue
+		if leaves is not None:
+			expected = dict(index.leaves(hashValue, method))
+			changed = [node for (node, leaf) in leaves if expected.get(node, leaf) != leaf]
+			if changed:
+				print "  Changed datasets: " + " ".join(changed)
+		print "  Quarantined as " + quarantine(cacheDirectoryName, hashValue, path, method)
+		bad.append((hashValue, method))
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+	print "Checked " + str(len(jobs)) + " objects (" + str(totalSize >> 20) + "MB) in " + str(int(time.time() - start)) + "s"
+
+	unrepaired = 0
+	for (hashValue, method) in bad:
+		if not args.repair:
+			unrepaired += 1
+			continue
+		source = repair(cacheDirectoryName, index, hashValue, method, args.placement)
+		if source is None:
+			print "Cannot repair " + method + " " + hashValue + ": no source file with this hash left"
+			unrepaired += 1
+		else:
+			print "Repaired " + method + " " + hashValue + " from " + source
+	index.close()
+
+	print str(len(bad)) + " bad or missing objects, " + str(unrepaired) + " left unrepaired"
+	if unrepaired > 0:
+		sys.exit(1)
@@ -0,0 +1,144 @@
+import h5hash
+import h5cache
+import h5cacheindex
+import errno
+import os
+import sys
+import argparse
+#REQUIRES: A cache directory created by generateHashCache.py
+#MODIFIES: Deletes cache objects and their index records
+#EFFECTS: Keeps the total size of the cache objects within a byte budget
+
+
+# USAGE
+# ./gcHashCache.py [-b BUDGET] [-n] [--pin HASH] [--unpin HASH] [-M METHOD] [--rescan] [cacheDirectoryPath]
+#
+# The least recently accessed objects are deleted until the objects take
+# up at most BUDGET bytes (suffixes K, M, G and T are understood). Sizes
+# and access times come from the cache index, which generateHashCache.py
+# keeps up to date, so no directory scan is needed. Objects are protected
+# from eviction if they are pinned, or if a source file recorded in the
+# index still exists unchanged. Records of source files that were deleted
+# or modified since they were hashed are dropped along the way.
+#
+# --pin and --unpin set the pinned status of the object HASH of METHOD
+# (default: sha1:legacy). --rescan records the objects (and their
+# metadata) of a cache created before the index tracked them. -n only
+# reports what would be deleted.
+#
+# generateHashCache.py -b BUDGET runs the same collection at its end.
+
+
+def parseSize(text):
+	#"500G" -> 500 * 2**30
+	units = "KMGT"
+	text = text.strip().upper().rstrip("B")
+	if text and text[-1] in units:
+		return int(float(text[:-1]) * (1 << (10 * (units.index(text[-1]) + 1))))
+	return int(text)
+
+def isLive(index, hashValue, method, dryRun=False):
+	#whether a recorded source file of the object is still unchanged;
+	#stale source records are dropped unless dryRun
+	live = False
+	for (path, size, mtime, inode) in index.sources(hashValue, method):
+		try:
+			st = os.stat(path)
+		except OSError:
+			st = None
+		if st is not None and (st.st_size, st.st_mtime, st.st_ino) == (size, mtime, inode):
+			live = True
+		else:
+			if not dryRun:
+				index.forget(path, method)
+	return live
+
+def collect(cacheDirectoryName, index, budget, dryRun=False):
+	#evicts objects until at most budget bytes are used; returns the
+	#number of bytes still used
+	used = index.totalSize()
+	if used <= budget:
+		return used
+	for (hashValue, method, size) in index.evictionCandidates():
+		if used <= budget:
+			break
+		if isLive(index, hashValue, method, dryRun):
+			continue
+		print "Evicting " + method + " " + hashValue + " (" + str(size >> 20) + "MB)"
+		if dryRun:
+			used -= size
+			continue
+		try:
+			os.unlink(h5cache.cachePath(cacheDirectoryName, hashValue, method))
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+		index.removeObject(hashValue, method)
+		used -= size
+	if used > budget:
+		print "Cannot get under budget, the remaining objects are pinned or live"
+	return used
+
+def rescan(cacheDirectoryName, index):
+	#records the cache objects the index does not know about yet
+	known = set((hashValue, method) for (hashValue, method, size) in index.evictionCandidates())
+	for method in h5cache.listMethods(cacheDirectoryName):
+		for (hashValue, path) in h5cache.listObjects(cacheDirectoryName, method):
+			if (hashValue, method) not in known:
+				st = os.stat(path)
+				index.recordObject(hashValue, method, st.st_size, st.st_atime)
+				index.recordMetadata(hashValue, method, h5cache.readMetadata(path))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		prog='gcHashCache.py',
+		description='Evicts objects from an HDF5 hash cache directory')
+	parser.add_argument("cache", type=str,
+		help="""The cache directory.""")
+	parser.add_argument('-b',
+		'--budget',
+		help="""Maximum total size of the cache objects, e.g. 500G""",
+		type=parseSize)
+	parser.add_argument('-n',
+		'--dry-run',
+		help="""Only report what would be evicted""",
+		action="store_true")
+	parser.add_argument('--pin',
+		help="""Protect the object with this hash from eviction""",
+		action="append",
+		default=[])
+	parser.add_argument('--unpin',
+		help="""Remove the protection of the object with this hash""",
+		action="append",
+		default=[])
+	parser.add_argument('-M',
+		'--method',
+		help="""Hash method of the pinned objects (default: sha1:legacy)""",
+		default="sha1:legacy")
+	parser.add_argument('--rescan',
+		help="""Record cache objects missing from the index""",
+		action="store_true")
+	args = parser.parse_args()
+
+	cacheDirectoryName = os.path.normpath(args.cache) + os.sep
+	if not os.path.isdir(cacheDirectoryName):
+		sys.exit("Cache path given is not a directory.")
+	try:
+		h5hash.parseMethod(args.method)
+	except ValueError:
+		parser.error("invalid hash method " + args.method)
+
+	index = h5cacheindex.CacheIndex(cacheDirectoryName)
+	if args.rescan:
+		rescan(cacheDirectoryName, index)
+	for (hashes, pinned) in ((args.pin, True), (args.unpin, False)):
+		for hashValue in hashes:
+			if not index.pin(hashValue, args.method, pinned):
+				print "Unknown " + args.method + " object " + hashValue
+	if args.budget is not None:
+		used = collect(cacheDirectoryName, index, args.budget, args.dry_run)
+	else:
+		used = index.totalSize()
+	index.close()
+	print "Cache objects use " + str(used >> 20) + "MB"
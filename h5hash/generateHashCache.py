@@ -1,72 +1,245 @@
 import h5hash
+import h5cache
+import h5cacheindex
+import gcHashCache
 import os
 import fnmatch
 import sys
-import shutil
+import time
+import argparse
+import itertools
+import multiprocessing
 #REQUIRES: A directory containing at least one HDF5 file somewhere in its directory tree
 #MODIFIES: Creates a cache directory at outputDirectoryName and new files as appropriate
 #EFFECTS: Creates an HDF5 cache directory based on HDF5 *data* hashes
 
 
 # USAGE
-# ./generateHashCache.py [inputDirectoryPath] [cacheDirectoryPath]
-
-inputDirectoryPath = os.path.normpath(sys.argv[1]) + os.sep
-cacheDirectoryName = os.path.normpath(sys.argv[2]) + os.sep
-
-#check above directories
-
-if not os.path.isdir(inputDirectoryPath):
-	print "Input path given does not specify a directory."
-	raise IOError
-
-if not os.path.isdir(cacheDirectoryName) and not os.path.exists(cacheDirectoryName):
-	print "Creating cache directory..."
-	os.makedirs(cacheDirectoryName)
-elif not os.path.isdir(cacheDirectoryName) and os.path.exists(cacheDirectoryName):
-	print "Cache path given is not a directory."
-	raise IOError
-else:
-	print "Cache directory exists, proceeding..."
-
-
-print "Searching directory tree for files..."
-
-hdf5files = []
-#matching pattern, disregard autorectify files
-for root, dirs, files in os.walk(inputDirectoryPath):
-	for filename in fnmatch.filter(files, "*.hdf5"):
-		if "autorectify" not in filename:
-			hdf5files.append(os.path.join(root,filename))
-
-#print to user how many files were found
-if len(hdf5files) == 0:
-	print "No HDF5 data files were found in input directory"
-	sys.exit()
-else:
-	print str(len(hdf5files)) + " HDF5 data files were found."
-
-for file in hdf5files:
-	print "Processing file " + file
-	print "File has size " + str(os.path.getsize(file) >> 20) + "MB"
-	currentFile = h5hash.H5HashFile(file)
+# ./generateHashCache.py [-j JOBS] [-f] [-p PLACEMENT] [-F FLAVOR] [-a ALGORITHM] [-M METHOD] [-b BUDGET] [inputDirectoryPath] [cacheDirectoryPath] ["legacy"|"stream"|"merkle"]
+#
+# Hash methods other than sha1 legacy store their objects in a cache
+# subdirectory named after the method, e.g. [cacheDirectoryPath]/sha1-stream/
+# or, with -F chunks (see h5hash.FLAVORS) and -a blake2b (see
+# h5hash.ALGORITHMS), [cacheDirectoryPath]/blake2b-stream-chunks/
+#
+# With -M METHOD (e.g. -M sha1:legacy), the objects cached by METHOD in
+# [inputDirectoryPath], which is then a cache directory itself, are hashed
+# and placed into [cacheDirectoryPath] instead. This migrates a cache to
+# another hash method; both may be the same directory, and -p link avoids
+# copying the objects. The source file records of the index are carried
+# over, so the next incremental run with the new method skips them.
+#
+# With -j, files are hashed by a pool of JOBS worker processes. Only the
+# main process writes to the cache, in the order the hashes come in.
+# In merkle mode, files are hashed one after another instead and the JOBS
+# processes hash the datasets of each file. The leaf hashes are recorded
+# in the index, and a changed file reports which of its datasets changed.
+#
+# Hashes are recorded in [cacheDirectoryPath]/index.sqlite together with
+# the size, mtime and inode of the source file. Files whose stat data is
+# unchanged and whose cache object exists are skipped without rehashing;
+# -f rehashes every file regardless.
+#
+# -p selects how files are put into the cache (see h5cache.PLACEMENTS):
+# "copy" (the default) rewrites every object, "reflink" and "link" leave
+# objects that are already present alone and clone or hardlink new ones
+# where the filesystem allows it. All copies are written to a temporary
+# file, fsynced and renamed into place.
+#
+# With -b, objects are evicted at the end of the run until the cache fits
+# into BUDGET bytes (see gcHashCache.py). The index tracks the size and
+# last access of every object for this; objects of skipped unchanged
+# files count as accessed.
+#
+# The index also records the /images attributes (opticalSystem, numFrames,
+# optics) and the shape of every dataset of each object; queryHashCache.py
+# answers metadata questions from it.
+
+
+def findFiles(inputDirectoryPath):
+	hdf5files = []
+	#matching pattern, disregard autorectify files
+	for root, dirs, files in os.walk(inputDirectoryPath):
+		for filename in fnmatch.filter(files, "*.hdf5"):
+			if "autorectify" not in filename:
+				hdf5files.append(os.path.join(root,filename))
+	return hdf5files
+
+def hashFile(job):
+	#runs in the worker processes; returns (file, hash, method, leaves, metadata, size, seconds)
+	(file, hashMode, flavor, algorithm, datasetJobs) = job
+	start = time.time()
+	currentFile = h5hash.H5HashFile(file, hashMode, flavor, datasetJobs, algorithm)
 	hashValue = currentFile.process()
-	
+	metadata = h5cache.readMetadata(file)
+	return (file, hashValue, currentFile.method, currentFile.leaves, metadata, os.path.getsize(file), time.time() - start)
+
+def changedDatasets(oldLeaves, newLeaves):
+	#node paths whose leaf hash differs, including added and removed nodes
+	return sorted(set(path for (path, leaf) in set(oldLeaves) ^ set(newLeaves)))
+
+def cacheFile(file, hashValue, method, cacheDirectoryName, placement):
+	destination = h5cache.cachePath(cacheDirectoryName, hashValue, method)
+	prefixDirectoryName = os.path.dirname(destination) + os.sep
+
 	#Cache prefix directory stuff
-	if os.path.isdir(cacheDirectoryName + hashValue[:2] + os.sep):
+	if os.path.isdir(prefixDirectoryName):
 		#exists already, no need to make it
 		print "Cache prefix directory already exists"
-	elif os.path.exists(cacheDirectoryName + hashValue[:2] + os.sep):
+	elif os.path.exists(prefixDirectoryName):
 		raise IOError
 	else:
 		print "Creating cache prefix directory"
-		os.makedirs(cacheDirectoryName + hashValue[:2] + os.sep)
+		os.makedirs(prefixDirectoryName)
 
 	#Cache file stuff
-	#overwrite by default, due to changing versions of attributes
-	print "Copying file to cache directory..."
-	shutil.copy(file, cacheDirectoryName + hashValue[:2] + os.sep + hashValue[2:])
-	print "Finished processing " + file
+	#the copy placement overwrites by default, due to changing versions of attributes
+	print "Placing file in cache directory (" + placement + ")..."
+	print "Cache object " + h5cache.placeFile(file, destination, placement)
 
+def throughput(size, seconds):
+	#MB/s as a printable string
+	return "%.1f MB/s" % (float(size) / (1 << 20) / max(seconds, 1e-6))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		prog='generateHashCache.py',
+		description='Creates an HDF5 cache directory based on HDF5 data hashes')
+	parser.add_argument("input", type=str,
+		help="""The directory tree to search for HDF5 files.""")
+	parser.add_argument("cache", type=str,
+		help="""The cache directory.""")
+	parser.add_argument("mode", type=str, nargs="?", default="legacy",
+		choices=h5hash.MODES,
+		help="""The hash mode (default: legacy).""")
+	parser.add_argument('-F',
+		'--flavor',
+		help="""The hash flavor of the stream and merkle modes (default: data)""",
+		choices=h5hash.FLAVORS,
+		default="data")
+	parser.add_argument('-a',
+		'--algorithm',
+		help="""The hash algorithm (default: sha1)""",
+		choices=sorted(h5hash.ALGORITHMS),
+		default="sha1")
+	parser.add_argument('-M',
+		'--migrate-from',
+		help="""Migrate the objects of the cache given as input from this hash method, e.g. sha1:legacy""")
+	parser.add_argument('-j',
+		'--jobs',
+		help="""Number of files hashed concurrently (default: 1)""",
+		type=int,
+		default=1)
+	parser.add_argument('-f',
+		'--force',
+		help="""Rehash all files, even those unchanged since the last run""",
+		action="store_true")
+	parser.add_argument('-p',
+		'--placement',
+		help="""How files are placed in the cache (default: copy)""",
+		choices=h5cache.PLACEMENTS,
+		default="copy")
+	parser.add_argument('-b',
+		'--budget',
+		help="""Evict objects until the cache takes up at most this much space, e.g. 500G""",
+		type=gcHashCache.parseSize)
+	args = parser.parse_args()
+	if args.mode == "legacy" and args.flavor != "data":
+		parser.error("the legacy hash mode only supports the data flavor")
+	if args.migrate_from is not None:
+		try:
+			h5hash.parseMethod(args.migrate_from)
+		except ValueError:
+			parser.error("invalid hash method " + args.migrate_from)
+
+	inputDirectoryPath = os.path.normpath(args.input) + os.sep
+	cacheDirectoryName = os.path.normpath(args.cache) + os.sep
+	if args.jobs < 1:
+		sys.exit("The number of jobs must be at least 1.")
+
+	#check above directories
+
+	if not os.path.isdir(inputDirectoryPath):
+		print "Input path given does not specify a directory."
+		raise IOError
+
+	if not os.path.isdir(cacheDirectoryName) and not os.path.exists(cacheDirectoryName):
+		print "Creating cache directory..."
+		os.makedirs(cacheDirectoryName)
+	elif not os.path.isdir(cacheDirectoryName) and os.path.exists(cacheDirectoryName):
+		print "Cache path given is not a directory."
+		raise IOError
+	else:
+		print "Cache directory exists, proceeding..."
+
+
+	if args.migrate_from is None:
+		print "Searching directory tree for files..."
+		hdf5files = findFiles(inputDirectoryPath)
+	else:
+		print "Listing " + args.migrate_from + " cache objects..."
+		sourceIndex = h5cacheindex.CacheIndex(inputDirectoryPath)
+		objectHashes = dict((path, hashValue) for (hashValue, path) in h5cache.listObjects(inputDirectoryPath, args.migrate_from))
+		hdf5files = sorted(objectHashes)
+
+	#print to user how many files were found
+	if len(hdf5files) == 0:
+		print "No HDF5 data files were found in input directory"
+		sys.exit()
+	else:
+		print str(len(hdf5files)) + " HDF5 data files were found."
+
+	index = h5cacheindex.CacheIndex(cacheDirectoryName)
+	method = h5hash.hashMethod(args.mode, args.flavor, args.algorithm)
+	stats = {}
+	jobs = []
+	unchanged = []
+	for file in hdf5files:
+		stats[file] = os.stat(file)
+		if not args.force and args.migrate_from is None:
+			hashValue = index.lookup(file, method, stats[file])
+			if hashValue is not None and os.path.isfile(h5cache.cachePath(cacheDirectoryName, hashValue, method)):
+				unchanged.append((hashValue, method))
+				continue
+		jobs.append(file)
+	index.touch(unchanged)
+	print str(len(hdf5files) - len(jobs)) + " files are unchanged since the last run, skipping them."
+
+	if args.jobs > 1 and args.mode != "merkle":
+		print "Hashing with " + str(args.jobs) + " worker processes"
+		pool = multiprocessing.Pool(args.jobs)
+		results = pool.imap_unordered(hashFile, [(file, args.mode, args.flavor, args.algorithm, 1) for file in jobs])
+	else:
+		pool = None
+		results = itertools.imap(hashFile, [(file, args.mode, args.flavor, args.algorithm, args.jobs) for file in jobs])
 
+	start = time.time()
+	totalSize = 0
+	for (file, hashValue, method, leaves, metadata, size, seconds) in results:
+		print "Processing file " + file
+		print "File has size " + str(size >> 20) + "MB, hashed at " + throughput(size, seconds)
+		cacheFile(file, hashValue, method, cacheDirectoryName, args.placement)
+		index.recordObject(hashValue, method, os.path.getsize(h5cache.cachePath(cacheDirectoryName, hashValue, method)))
+		index.recordMetadata(hashValue, method, metadata)
+		if leaves is not None:
+			oldHashValue = index.lookup(file, method)
+			if oldHashValue is not None and oldHashValue != hashValue:
+				print "Changed datasets: " + " ".join(changedDatasets(index.leaves(oldHashValue, method), leaves))
+			index.recordLeaves(hashValue, method, leaves)
+		if args.migrate_from is None:
+			index.record(file, method, stats[file], hashValue)
+		else:
+			index.migrate(sourceIndex, objectHashes[file], args.migrate_from, hashValue, method)
+		totalSize += size
+		print "Finished processing " + file
 
+	if pool is not None:
+		pool.close()
+		pool.join()
+	if args.budget is not None:
+		print "Cache objects use " + str(gcHashCache.collect(cacheDirectoryName, index, args.budget) >> 20) + "MB"
+	index.close()
+	if args.migrate_from is not None:
+		sourceIndex.close()
+	print "Processed " + str(totalSize >> 20) + "MB in total at " + throughput(totalSize, time.time() - start)
@@ -0,0 +1,156 @@
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+
+import numpy
+import tables
+
+import h5hash
+
+# Placement modes for putting a file into the cache:
+#   copy    - always (re)write the object with a full copy, so that the
+#             cache picks up changed attributes of an already cached file
+#   reflink - leave an existing object alone; otherwise clone the file
+#             (copy-on-write, btrfs/XFS) or fall back to a copy
+#   link    - like reflink, but try a hardlink first. The object then
+#             shares its inode with the source, so in-place modifications
+#             of the source show up in the cache too
+PLACEMENTS = ("copy", "reflink", "link")
+
+#ioctl(2) request number of FICLONE, from <linux/fs.h>
+FICLONE = 0x40049409
+
+COPY_BUFFER_SIZE = 1 << 20
+
+#Cache subdirectory where fsckHashCache.py moves corrupted objects
+QUARANTINE_DIRECTORY = "quarantine"
+
+
+def cachePath(cacheDirectoryName, hashValue, method):
+	#path of the cache object with the given hash
+	return os.path.join(cacheDirectoryName, h5hash.namespace(method), hashValue[:2], hashValue[2:])
+
+def listObjects(cacheDirectoryName, method):
+	#yields (hash, path) of every object in the namespace of method
+	namespaceDirectoryName = os.path.join(cacheDirectoryName, h5hash.namespace(method))
+	if not os.path.isdir(namespaceDirectoryName):
+		return
+	for prefix in sorted(os.listdir(namespaceDirectoryName)):
+		prefixDirectoryName = os.path.join(namespaceDirectoryName, prefix)
+		#the cache root also holds the index and other namespaces
+		if len(prefix) != 2 or not os.path.isdir(prefixDirectoryName):
+			continue
+		for rest in sorted(os.listdir(prefixDirectoryName)):
+			#skip temporary files of placeFile()
+			if not rest.startswith("."):
+				yield (prefix + rest, os.path.join(prefixDirectoryName, rest))
+
+def listMethods(cacheDirectoryName):
+	#returns the hash methods that have a namespace in the cache
+	methods = []
+	for name in sorted(os.listdir(cacheDirectoryName)):
+		if not os.path.isdir(os.path.join(cacheDirectoryName, name)):
+			continue
+		if len(name) == 2:
+			name = ""
+		try:
+			method = h5hash.namespaceMethod(name)
+		except ValueError:
+			continue
+		if method not in methods:
+			methods.append(method)
+	return methods
+
+def quarantinePath(cacheDirectoryName, hashValue, method):
+	return os.path.join(cacheDirectoryName, QUARANTINE_DIRECTORY, method.replace(":", "-"), hashValue)
+
+def attributeValue(value):
+	#converts an HDF5 attribute to something JSON can store
+	if isinstance(value, numpy.ndarray):
+		return value.tolist()
+	if isinstance(value, numpy.generic):
+		return value.item()
+	return value
+
+def readMetadata(file):
+	#returns a dict with the opticalSystem, numFrames and attributes of the
+	#/images group and the (node path, shape, dtype) of every dataset
+	h5file = tables.open_file(file, mode="r")
+	try:
+		try:
+			imageGroup = h5file.get_node("/images")
+		except tables.NoSuchNodeError:
+			imageGroup = h5file.root
+		attrs = imageGroup._v_attrs
+		attributes = dict((name, attributeValue(attrs[name])) for name in attrs._f_list("user"))
+		datasets = []
+		for group in h5file.walk_groups("/"):
+			for array in h5file.list_nodes(group, classname='Array'):
+				datasets.append((array._v_pathname, tuple(int(length) for length in array.shape), array.dtype.str))
+		numFrames = attributes.get("numFrames")
+		if numFrames is None:
+			numFrames = len([node for (node, shape, dtype) in datasets if node.startswith(imageGroup._v_pathname)])
+		return {
+			"opticalSystem": attributes.get("opticalSystem"),
+			"numFrames": int(numFrames),
+			"attributes": attributes,
+			"datasets": sorted(datasets)}
+	finally:
+		h5file.close()
+
+def reflink(sourceFile, destinationFile):
+	#clones sourceFile's extents into destinationFile (both open files);
+	#returns False if the filesystem cannot do that
+	try:
+		fcntl.ioctl(destinationFile.fileno(), FICLONE, sourceFile.fileno())
+	except (IOError, OSError):
+		return False
+	return True
+
+def fsyncDirectory(directoryName):
+	fd = os.open(directoryName, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def placeFile(file, destination, placement="copy"):
+	#puts file into the cache as destination; returns how it was placed,
+	#one of "present", "hardlink", "reflink" or "copy"
+	if placement not in PLACEMENTS:
+		raise ValueError("unknown placement " + str(placement))
+	if placement != "copy" and os.path.isfile(destination):
+		return "present"
+
+	directoryName = os.path.dirname(destination)
+	if placement == "link":
+		try:
+			os.link(file, destination)
+			return "hardlink"
+		except OSError as e:
+			if e.errno == errno.EEXIST:
+				return "present"
+			#other filesystem, or links not supported; clone or copy instead
+
+	#write to a temporary file next to the destination, then rename it
+	#into place atomically so that readers never see a partial object
+	(fd, temporaryName) = tempfile.mkstemp(dir=directoryName, prefix="." + os.path.basename(destination) + ".")
+	try:
+		with os.fdopen(fd, "wb") as destinationFile:
+			with open(file, "rb") as sourceFile:
+				if placement != "copy" and reflink(sourceFile, destinationFile):
+					method = "reflink"
+				else:
+					shutil.copyfileobj(sourceFile, destinationFile, COPY_BUFFER_SIZE)
+					method = "copy"
+				destinationFile.flush()
+				os.fsync(destinationFile.fileno())
+		shutil.copymode(file, temporaryName)
+		os.rename(temporaryName, destination)
+	except:
+		os.unlink(temporaryName)
+		raise
+	fsyncDirectory(directoryName)
+	return method
@@ -0,0 +1,216 @@
+import json
+import os
+import sqlite3
+import time
+
+#The index lives in the cache directory, next to the hash prefix directories
+INDEX_FILENAME = "index.sqlite"
+
+
+class CacheIndex:
+	#persistent index of the source files hashed into a cache directory;
+	#maps (path, size, mtime, inode) to the data hash of the file
+	def __init__(self, cacheDirectoryName):
+		self.filepath = os.path.join(cacheDirectoryName, INDEX_FILENAME)
+		self.db = sqlite3.connect(self.filepath)
+		self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+			path TEXT NOT NULL,
+			method TEXT NOT NULL,
+			size INTEGER NOT NULL,
+			mtime REAL NOT NULL,
+			inode INTEGER NOT NULL,
+			hash TEXT NOT NULL,
+			PRIMARY KEY (path, method))""")
+		self.db.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash, method)")
+		#per-dataset leaf hashes of cache objects hashed in merkle mode
+		self.db.execute("""CREATE TABLE IF NOT EXISTS leaves (
+			hash TEXT NOT NULL,
+			method TEXT NOT NULL,
+			node TEXT NOT NULL,
+			leaf TEXT NOT NULL,
+			PRIMARY KEY (hash, method, node))""")
+		#the objects in the cache, with their last access time for eviction;
+		#pinned objects are never evicted
+		self.db.execute("""CREATE TABLE IF NOT EXISTS objects (
+			hash TEXT NOT NULL,
+			method TEXT NOT NULL,
+			size INTEGER NOT NULL,
+			atime REAL NOT NULL,
+			pinned INTEGER NOT NULL DEFAULT 0,
+			PRIMARY KEY (hash, method))""")
+		self.db.execute("CREATE INDEX IF NOT EXISTS objects_atime ON objects (pinned, atime)")
+		#metadata of the objects, so that it can be queried without opening
+		#the HDF5 files; attributes holds the /images attributes as JSON
+		self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+			hash TEXT NOT NULL,
+			method TEXT NOT NULL,
+			opticalSystem TEXT,
+			numFrames INTEGER,
+			attributes TEXT NOT NULL,
+			PRIMARY KEY (hash, method))""")
+		self.db.execute("CREATE INDEX IF NOT EXISTS metadata_opticalsystem ON metadata (opticalSystem)")
+		self.db.execute("""CREATE TABLE IF NOT EXISTS datasets (
+			hash TEXT NOT NULL,
+			method TEXT NOT NULL,
+			node TEXT NOT NULL,
+			shape TEXT NOT NULL,
+			dtype TEXT NOT NULL,
+			PRIMARY KEY (hash, method, node))""")
+		#source file basenames; indexes created before the metadata tables
+		#lack this column and get it filled in here
+		if "basename" not in [row[1] for row in self.db.execute("PRAGMA table_info(files)")]:
+			self.db.execute("ALTER TABLE files ADD COLUMN basename TEXT")
+			self.db.executemany("UPDATE files SET basename = ? WHERE path = ?",
+				[(os.path.basename(row[0]), row[0]) for row in self.db.execute("SELECT path FROM files").fetchall()])
+		self.db.execute("CREATE INDEX IF NOT EXISTS files_basename ON files (basename)")
+		self.db.commit()
+
+	def lookup(self, path, method, st=None):
+		#returns the hash recorded for path, or None if the file is not
+		#indexed or its size, mtime or inode differ from the stat result st
+		#(if given)
+		row = self.db.execute("SELECT size, mtime, inode, hash FROM files WHERE path = ? AND method = ?",
+			(os.path.abspath(path), method)).fetchone()
+		if row is None:
+			return None
+		if st is not None and tuple(row[:3]) != (st.st_size, st.st_mtime, st.st_ino):
+			return None
+		return row[3]
+
+	def record(self, path, method, st, hashValue):
+		self.db.execute("INSERT OR REPLACE INTO files (path, method, size, mtime, inode, hash, basename) VALUES (?, ?, ?, ?, ?, ?, ?)",
+			(os.path.abspath(path), method, st.st_size, st.st_mtime, st.st_ino, hashValue, os.path.basename(path)))
+		self.db.commit()
+
+	def sources(self, hashValue, method):
+		#returns [(path, size, mtime, inode)] of the files recorded with the hash
+		return [tuple(row) for row in self.db.execute(
+			"SELECT path, size, mtime, inode FROM files WHERE hash = ? AND method = ? ORDER BY path",
+			(hashValue, method))]
+
+	def hashes(self, method):
+		#returns the set of hashes recorded for method
+		return set(row[0] for row in self.db.execute(
+			"SELECT DISTINCT hash FROM files WHERE method = ?", (method,)))
+
+	def recordLeaves(self, hashValue, method, leaves):
+		#leaves is [(node path, leaf hash)] as produced by a merkle hash
+		self.db.executemany("INSERT OR REPLACE INTO leaves (hash, method, node, leaf) VALUES (?, ?, ?, ?)",
+			[(hashValue, method, path, leaf) for (path, leaf) in leaves])
+		self.db.commit()
+
+	def leaves(self, hashValue, method):
+		#returns [(node path, leaf hash)] of a cache object in canonical order
+		return [tuple(row) for row in self.db.execute(
+			"SELECT node, leaf FROM leaves WHERE hash = ? AND method = ? ORDER BY node",
+			(hashValue, method))]
+
+	def migrate(self, sourceIndex, hashValue, method, newHashValue, newMethod):
+		#records the source files of the object hashValue from sourceIndex
+		#(which may be self) as hashed to newHashValue by newMethod
+		rows = sourceIndex.db.execute("SELECT path, size, mtime, inode FROM files WHERE hash = ? AND method = ?",
+			(hashValue, method)).fetchall()
+		self.db.executemany("INSERT OR REPLACE INTO files (path, method, size, mtime, inode, hash, basename) VALUES (?, ?, ?, ?, ?, ?, ?)",
+			[(path, newMethod, size, mtime, inode, newHashValue, os.path.basename(path)) for (path, size, mtime, inode) in rows])
+		self.db.commit()
+
+	def forget(self, path, method):
+		#drops the record of a source file
+		self.db.execute("DELETE FROM files WHERE path = ? AND method = ?", (path, method))
+		self.db.commit()
+
+	def recordObject(self, hashValue, method, size, atime=None):
+		#records an object placed in the cache, keeping its pinned status
+		if atime is None:
+			atime = time.time()
+		cursor = self.db.execute("UPDATE objects SET size = ?, atime = ? WHERE hash = ? AND method = ?",
+			(size, atime, hashValue, method))
+		if cursor.rowcount == 0:
+			self.db.execute("INSERT INTO objects (hash, method, size, atime) VALUES (?, ?, ?, ?)",
+				(hashValue, method, size, atime))
+		self.db.commit()
+
+	def touch(self, objects):
+		#marks the (hash, method) objects as accessed now
+		now = time.time()
+		self.db.executemany("UPDATE objects SET atime = ? WHERE hash = ? AND method = ?",
+			[(now, hashValue, method) for (hashValue, method) in objects])
+		self.db.commit()
+
+	def pin(self, hashValue, method, pinned=True):
+		#returns False if the object is not indexed
+		cursor = self.db.execute("UPDATE objects SET pinned = ? WHERE hash = ? AND method = ?",
+			(int(pinned), hashValue, method))
+		self.db.commit()
+		return cursor.rowcount > 0
+
+	def totalSize(self):
+		return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+	def evictionCandidates(self):
+		#returns [(hash, method, size)] of the unpinned objects, least
+		#recently accessed first
+		return [tuple(row) for row in self.db.execute(
+			"SELECT hash, method, size FROM objects WHERE pinned = 0 ORDER BY atime")]
+
+	def removeObject(self, hashValue, method):
+		self.db.execute("DELETE FROM objects WHERE hash = ? AND method = ?", (hashValue, method))
+		self.db.execute("DELETE FROM leaves WHERE hash = ? AND method = ?", (hashValue, method))
+		self.db.execute("DELETE FROM metadata WHERE hash = ? AND method = ?", (hashValue, method))
+		self.db.execute("DELETE FROM datasets WHERE hash = ? AND method = ?", (hashValue, method))
+		self.db.commit()
+
+	def recordMetadata(self, hashValue, method, metadata):
+		#metadata is a dict as returned by h5cache.readMetadata()
+		self.db.execute("INSERT OR REPLACE INTO metadata (hash, method, opticalSystem, numFrames, attributes) VALUES (?, ?, ?, ?, ?)",
+			(hashValue, method, metadata["opticalSystem"], metadata["numFrames"], json.dumps(metadata["attributes"], sort_keys=True)))
+		self.db.execute("DELETE FROM datasets WHERE hash = ? AND method = ?", (hashValue, method))
+		self.db.executemany("INSERT INTO datasets (hash, method, node, shape, dtype) VALUES (?, ?, ?, ?, ?)",
+			[(hashValue, method, node, ",".join(str(length) for length in shape), dtype)
+				for (node, shape, dtype) in metadata["datasets"]])
+		self.db.commit()
+
+	def query(self, hashValue=None, method=None, basename=None, opticalSystem=None):
+		#returns a list of dicts describing the matching cache objects:
+		#hash, method, size, pinned, opticalSystem, numFrames, attributes
+		#and the paths of the source files
+		conditions = []
+		parameters = []
+		if hashValue is not None:
+			conditions.append("o.hash = ?")
+			parameters.append(hashValue)
+		if method is not None:
+			conditions.append("o.method = ?")
+			parameters.append(method)
+		if basename is not None:
+			conditions.append("EXISTS (SELECT 1 FROM files f WHERE f.hash = o.hash AND f.method = o.method AND f.basename = ?)")
+			parameters.append(basename)
+		if opticalSystem is not None:
+			conditions.append("m.opticalSystem = ?")
+			parameters.append(opticalSystem)
+		sql = """SELECT o.hash, o.method, o.size, o.pinned, m.opticalSystem, m.numFrames, m.attributes
+			FROM objects o LEFT JOIN metadata m ON m.hash = o.hash AND m.method = o.method"""
+		if conditions:
+			sql += " WHERE " + " AND ".join(conditions)
+		results = []
+		for row in self.db.execute(sql + " ORDER BY o.hash, o.method", parameters).fetchall():
+			results.append({
+				"hash": row[0],
+				"method": row[1],
+				"size": row[2],
+				"pinned": bool(row[3]),
+				"opticalSystem": row[4],
+				"numFrames": row[5],
+				"attributes": json.loads(row[6]) if row[6] is not None else None,
+				"paths": [source[0] for source in self.sources(row[0], row[1])]})
+		return results
+
+	def datasets(self, hashValue, method):
+		#returns [(node path, shape tuple, dtype)] of a cache object
+		return [(node, tuple(int(length) for length in shape.split(",") if length), dtype)
+			for (node, shape, dtype) in self.db.execute(
+				"SELECT node, shape, dtype FROM datasets WHERE hash = ? AND method = ? ORDER BY node",
+				(hashValue, method))]
+
+	def close(self):
+		self.db.close()
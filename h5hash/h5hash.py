@@ -1,26 +1,288 @@
+import argparse
 import hashlib
+import itertools
+import multiprocessing
 import numpy
 import tables
 
+# Hash modes:
+#   legacy - every Array upcast to float64 and concatenated; kept so that
+#            hashes of existing caches stay valid
+#   stream - every Array hashed in its native dtype
+#   merkle - every Array hashed on its own (a "leaf" hash, the same as the
+#            stream hash of that Array alone); the file hash is the hash of
+#            the "<node path> <leaf hash>\n" lines sorted by node path
+# All modes feed the data to the hasher block by block, so memory use
+# does not depend on the size of the file.
+MODES = ("legacy", "stream", "merkle")
+
+# Hash flavors, i.e. which bytes of an Array are hashed in the stream and
+# merkle modes:
+#   data   - the decoded data
+#   chunks - the chunks as stored in the file, read with the direct chunk
+#            API of h5py (2.10 or newer) without decompressing them.
+#            Every chunk is hashed as its start coordinates, filter mask
+#            and stored bytes. Contiguous Arrays have no chunks and are
+#            hashed as decoded data. Hashes depend on the compression
+#            settings of the file, so they only identify files written
+#            the same way (e.g. by tiff2hdf).
+FLAVORS = ("data", "chunks")
+
+# Hash algorithms. sha1 is the default and the only one legacy caches use;
+# blake2b needs Python 3.6+ or the pyblake2 module, the xxh* digests need
+# the xxhash module. The xxh* digests are not cryptographic and only meant
+# for deduplication.
+ALGORITHMS = {
+	"sha1": hashlib.sha1,
+	"sha256": hashlib.sha256,
+}
+if hasattr(hashlib, "blake2b"):
+	ALGORITHMS["blake2b"] = hashlib.blake2b
+else:
+	try:
+		import pyblake2
+		ALGORITHMS["blake2b"] = pyblake2.blake2b
+	except ImportError:
+		pass
+try:
+	import h5py
+except ImportError:
+	h5py = None
+try:
+	import xxhash
+	ALGORITHMS["xxh64"] = xxhash.xxh64
+	if hasattr(xxhash, "xxh3_128"):
+		ALGORITHMS["xxh128"] = xxhash.xxh3_128
+except ImportError:
+	pass
+
+# Upper bound on the amount of data read from a single Array at once
+STREAM_BLOCK_BYTES = 16 << 20
+
+
+def hashMethod(mode, flavor="data", algorithm="sha1"):
+	#names the way a hash was computed, e.g. "sha1:stream" or
+	#"blake2b:merkle:chunks"
+	if flavor == "data":
+		return algorithm + ":" + mode
+	return algorithm + ":" + mode + ":" + flavor
+
+def parseMethod(method):
+	#inverse of hashMethod(); returns (mode, flavor, algorithm)
+	parts = method.split(":")
+	if len(parts) == 2:
+		parts.append("data")
+	if len(parts) != 3:
+		raise ValueError("invalid hash method " + method)
+	(algorithm, mode, flavor) = parts
+	return (mode, flavor, algorithm)
+
+def namespace(method):
+	#returns the cache subdirectory holding objects hashed by method, e.g.
+	#"blake2b-stream", so that caches of different methods can share a
+	#directory; sha1 legacy hashes live directly in the cache root, where
+	#h5torrent looks for them
+	if method == "sha1:legacy":
+		return ""
+	return method.replace(":", "-")
+
+def namespaceMethod(name):
+	#inverse of namespace(); raises ValueError for other directory names
+	if name == "":
+		return "sha1:legacy"
+	method = name.replace("-", ":")
+	(mode, flavor, algorithm) = parseMethod(method)
+	if mode not in MODES or flavor not in FLAVORS or algorithm not in ALGORITHMS:
+		raise ValueError("not a hash method namespace: " + name)
+	return method
+
+def coords(values):
+	#canonical text form of a shape or chunk coordinates
+	return ",".join("%d" % value for value in values)
+
+def hashNodes(job):
+	#runs in the worker processes of a merkle hash
+	(filepath, flavor, algorithm, paths) = job
+	currentFile = H5HashFile(filepath, "merkle", flavor, algorithm=algorithm)
+	try:
+		return currentFile.hashNodes(paths)
+	finally:
+		currentFile.close()
+
 
 class H5HashFile:
 	#class to process hash
-	def __init__(self, filepath):
+	def __init__(self, filepath, mode="legacy", flavor="data", jobs=1, algorithm="sha1"):
+		if mode not in MODES:
+			raise ValueError("unknown hash mode " + str(mode))
+		if flavor not in FLAVORS or (mode == "legacy" and flavor != "data"):
+			raise ValueError("unknown hash flavor " + str(flavor) + " for mode " + mode)
+		if algorithm not in ALGORITHMS:
+			raise ValueError("unknown or unavailable hash algorithm " + str(algorithm))
 		self.filepath = filepath
+		self.mode = mode
+		self.flavor = flavor
+		self.algorithm = algorithm
+		self.method = hashMethod(mode, flavor, algorithm)
+		#number of processes hashing the leaves of a merkle hash
+		self.jobs = jobs
 		self.h5file = tables.open_file(filepath, mode="r")
-		self.giantArray = numpy.array([]) #creates an emtpy 1D array to hold all data in a file
+		#h5py handle of the file, opened by the chunks flavor
+		self.chunkFile = None
+		self.hasher = ALGORITHMS[algorithm]()
+		#[(node path, leaf hash)] in canonical order, set by a merkle hash
+		self.leaves = None
 
-	def __getData(self):
+	def __arrays(self):
 		for group in self.h5file.walk_groups("/"):
 			for array in self.h5file.list_nodes(group,classname='Array'):
-				self.giantArray = numpy.append(self.giantArray, array.read().flatten())
-		self.h5file.close()
+				yield array
+
+	def __blocks(self, array):
+		#yields the array as C-ordered blocks of whole rows
+		if len(array.shape) == 0:
+			yield array.read()
+			return
+		rowbytes = array.dtype.itemsize * int(numpy.prod(array.shape[1:]))
+		rows = max(1, STREAM_BLOCK_BYTES // max(1, rowbytes))
+		if array.chunkshape is not None:
+			#align blocks with chunk rows so every chunk is decompressed once
+			step = array.chunkshape[0]
+			rows = max(step, rows // step * step)
+		for start in xrange(0, array.shape[0], rows):
+			yield array[start:start + rows]
+
+	def __feed(self, hasher, block):
+		if self.mode == "legacy":
+			#same bytes numpy.append() onto a float64 array would produce
+			block = block.astype(numpy.result_type(numpy.float64, block.dtype))
+		elif block.dtype.byteorder == ">":
+			block = block.astype(block.dtype.newbyteorder("<"))
+		block = numpy.ascontiguousarray(block).reshape(-1)
+		hasher.update(block.view(numpy.uint8)) #done this way for speed
+
+	def __feedChunks(self, hasher, array):
+		if h5py is None or not hasattr(h5py.h5d.DatasetID, "read_direct_chunk"):
+			raise RuntimeError("the chunks hash flavor needs h5py 2.10 or newer")
+		if self.chunkFile is None:
+			self.chunkFile = h5py.File(self.filepath, "r")
+		dsetid = self.chunkFile[array._v_pathname].id
+		hasher.update("%s %s %s\n" % (array.dtype.str, coords(array.shape), coords(array.chunkshape)))
+		grid = [xrange(0, length, step) for (length, step) in zip(array.shape, array.chunkshape)]
+		for start in itertools.product(*grid):
+			try:
+				(filterMask, data) = dsetid.read_direct_chunk(start)
+			except (RuntimeError, ValueError, KeyError, IOError):
+				#chunk never written; readers see the fill value
+				hasher.update("%s missing\n" % coords(start))
+				continue
+			#the byte offset in the file is left out, so that equal data
+			#stored at different places still hashes the same
+			hasher.update("%s %d %d\n" % (coords(start), filterMask, len(data)))
+			hasher.update(data)
+
+	def __hashArray(self, hasher, array):
+		if self.flavor == "chunks" and array.chunkshape is not None:
+			self.__feedChunks(hasher, array)
+		else:
+			for block in self.__blocks(array):
+				self.__feed(hasher, block)
+
+	def __getData(self):
+		try:
+			for array in self.__arrays():
+				self.__hashArray(self.hasher, array)
+		finally:
+			self.close()
+
+	def __getLeaves(self):
+		try:
+			paths = sorted(array._v_pathname for array in self.__arrays())
+			jobs = min(self.jobs, len(paths))
+			if jobs > 1:
+				self.close()
+				pool = multiprocessing.Pool(jobs)
+				try:
+					parts = pool.map(hashNodes, [(self.filepath, self.flavor, self.algorithm, paths[i::jobs]) for i in range(jobs)])
+				finally:
+					pool.close()
+					pool.join()
+				self.leaves = sorted(leaf for part in parts for leaf in part)
+			else:
+				self.leaves = self.hashNodes(paths)
+		finally:
+			self.close()
+		for (path, leaf) in self.leaves:
+			self.hasher.update(path + " " + leaf + "\n")
 
 	def __hash(self):
-		return hashlib.sha1(self.giantArray.view(numpy.uint8)).hexdigest() #done this way for speed
+		return self.hasher.hexdigest()
+
+	def hashNodes(self, paths):
+		#returns [(node path, leaf hash)] for the given Array nodes
+		leaves = []
+		for path in paths:
+			hasher = ALGORITHMS[self.algorithm]()
+			self.__hashArray(hasher, self.h5file.get_node(path))
+			leaves.append((path, hasher.hexdigest()))
+		return leaves
+
+	def close(self):
+		if self.h5file.isopen:
+			self.h5file.close()
+		if self.chunkFile is not None:
+			self.chunkFile.close()
+			self.chunkFile = None
 
 	def process(self):
-		self.__getData()
+		if self.mode == "merkle":
+			self.__getLeaves()
+		else:
+			self.__getData()
 		return self.__hash()
 
 
+# USAGE
+# ./h5hash.py [-m MODE] [-F FLAVOR] [-a ALGORITHM] [-j JOBS] [-l] file...
+#
+# Prints the data hash of every file. With -l, a merkle hash also prints
+# the leaf hash of every dataset, which can be compared against the cache
+# index to find out which frames differ.
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		prog='h5hash.py',
+		description='Computes HDF5 data hashes')
+	parser.add_argument("files", type=str, nargs="+",
+		help="""The HDF5 files to hash.""")
+	parser.add_argument('-m',
+		'--mode',
+		help="""The hash mode (default: legacy)""",
+		choices=MODES,
+		default="legacy")
+	parser.add_argument('-F',
+		'--flavor',
+		help="""The hash flavor of the stream and merkle modes (default: data)""",
+		choices=FLAVORS,
+		default="data")
+	parser.add_argument('-a',
+		'--algorithm',
+		help="""The hash algorithm (default: sha1)""",
+		choices=sorted(ALGORITHMS),
+		default="sha1")
+	parser.add_argument('-j',
+		'--jobs',
+		help="""Number of datasets hashed concurrently in merkle mode (default: 1)""",
+		type=int,
+		default=1)
+	parser.add_argument('-l',
+		'--leaves',
+		help="""Print the per-dataset leaf hashes of a merkle hash""",
+		action="store_true")
+	args = parser.parse_args()
+
+	for file in args.files:
+		currentFile = H5HashFile(file, args.mode, args.flavor, args.jobs, args.algorithm)
+		print currentFile.process() + "  " + file
+		if args.leaves and currentFile.leaves is not None:
+			for (path, leaf) in currentFile.leaves:
+				print "  " + leaf + "  " + path
@@ -0,0 +1,73 @@
+import h5cacheindex
+import os
+import sys
+import json
+import argparse
+#REQUIRES: A cache directory created by generateHashCache.py
+#EFFECTS: Prints the cache objects matching the given criteria
+
+
+# USAGE
+# ./queryHashCache.py [-H HASH] [-n BASENAME] [-o OPTICALSYSTEM] [-M METHOD] [-d] [-j] [cacheDirectoryPath]
+#
+# Answers questions about cache objects from the cache index alone, e.g.
+#
+#   ./queryHashCache.py -n punc31_gCAMP5_td_video32.hdf5 cache/
+#   ./queryHashCache.py -o LF -d cache/
+#
+# prints hash, hash method, size, number of frames, optical system and the
+# source paths of every matching object. With -d, the node path, shape and
+# dtype of every dataset are listed too; -j prints everything as JSON.
+#
+# From Python, use h5cacheindex.CacheIndex(cacheDirectoryPath).query(...).
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		prog='queryHashCache.py',
+		description='Queries the metadata index of an HDF5 hash cache directory')
+	parser.add_argument("cache", type=str,
+		help="""The cache directory.""")
+	parser.add_argument('-H',
+		'--hash',
+		help="""Only objects with this hash""")
+	parser.add_argument('-n',
+		'--basename',
+		help="""Only objects of source files with this basename""")
+	parser.add_argument('-o',
+		'--optical-system',
+		help="""Only objects with this opticalSystem attribute, e.g. LF""")
+	parser.add_argument('-M',
+		'--method',
+		help="""Only objects of this hash method, e.g. sha1:legacy""")
+	parser.add_argument('-d',
+		'--datasets',
+		help="""List the datasets of every object""",
+		action="store_true")
+	parser.add_argument('-j',
+		'--json',
+		help="""Print the results as JSON""",
+		action="store_true")
+	args = parser.parse_args()
+
+	cacheDirectoryName = os.path.normpath(args.cache) + os.sep
+	if not os.path.isfile(os.path.join(cacheDirectoryName, h5cacheindex.INDEX_FILENAME)):
+		sys.exit("No cache index found in " + cacheDirectoryName)
+
+	index = h5cacheindex.CacheIndex(cacheDirectoryName)
+	results = index.query(args.hash, args.method, args.basename, args.optical_system)
+	if args.datasets:
+		for result in results:
+			result["datasets"] = index.datasets(result["hash"], result["method"])
+	index.close()
+
+	if args.json:
+		print json.dumps(results, indent=1, sort_keys=True)
+		sys.exit(0)
+	for result in results:
+		print result["hash"], result["method"], str(result["size"] >> 20) + "MB", \
+			str(result["numFrames"]) + " frames", result["opticalSystem"]
+		for path in result["paths"]:
+			print "  " + path
+		for (node, shape, dtype) in result.get("datasets", []):
+			print "  " + node + " " + "x".join(str(length) for length in shape) + " " + dtype
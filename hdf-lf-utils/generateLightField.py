@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Resample every frame of a lightfield image once into a 4D
+# (u, v, s, t) lightfield and store it in the /lightfield dataset
+# of the same HDF5 file, next to /images
+#
+# Usage: ./generateLightField.py inputFile [radius [step [layout]]]
+#
+# The (U,V) viewpoints range from -radius to +radius (in pixels, by
+# default half the lens pitch) in the given steps (default 1). The
+# dataset has shape (frame, u, v, s, t), so that reading a view, a range
+# of views or an epipolar image is a plain slice:
+#
+#   lightfield[frame, i, j]        view (offsets_U[i], offsets_V[j])
+#   lightfield[frame, :, j, s, :]  epipolar image through lens row s
+#
+# How cheap these reads are depends on the chunk layout of the dataset:
+#
+#   views     - (default) one chunk per view; a view is read from a
+#               single chunk, but an epipolar image decompresses all
+#               u views of its column
+#   epipolar  - one chunk per band of lens rows across all u; an
+#               epipolar image is read from a single chunk about the
+#               size of a view, but a view decompresses u views worth
+#               of data
+#
+# The frame names and viewpoint offsets are stored in the 'frames',
+# 'offsets_U' and 'offsets_V' attributes of the dataset. An existing
+# /lightfield dataset is replaced.
+
+import math
+import sys
+
+import numpy
+import tables
+import hdf5lflib
+
+# Chunk shape of the (frame, u, v, s, t) dataset for a lightfield of the
+# given (u, v, s, t) shape
+LAYOUTS = {
+    'views': lambda U, V, S, T: (1, 1, 1, S, T),
+    'epipolar': lambda U, V, S, T: (1, U, 1, max(1, S // U), T),
+}
+
+def processFileLightField(filename, radius, step, layout = 'views'):
+    h5file = tables.open_file(filename, mode = "a")
+    ar = h5file.get_node('/', '/autorectification')
+    try:
+        cw = h5file.get_node('/', '/cropwindow')
+    except tables.NoSuchNodeError:
+        cw = None
+    if radius is None:
+        pitch = min(ar._v_attrs['right_dx'], ar._v_attrs['down_dy'])
+        radius = math.floor(pitch / 2.)
+    offsets = hdf5lflib.uv_offsets(radius, step)
+    # Keep the sampling plans of all views around for the next frame
+    hdf5lflib.PLAN_CACHE_SIZE = max(hdf5lflib.PLAN_CACHE_SIZE, len(offsets) ** 2)
+
+    frames = sorted(h5file.get_node('/', '/images')._v_children.items(), key = lambda j: int(j[0]))
+    if '/lightfield' in h5file:
+        print 'replacing existing /lightfield'
+        h5file.remove_node('/', 'lightfield')
+
+    lfarray = None
+    for (n, (i, node)) in enumerate(frames):
+        print filename, i
+        lightfield = hdf5lflib.compute_lightfield(node, ar, cw, offsets, offsets)
+        if lfarray is None:
+            lfarray = h5file.create_carray('/', 'lightfield',
+                    atom = tables.Atom.from_dtype(lightfield.dtype),
+                    shape = (len(frames),) + lightfield.shape,
+                    chunkshape = LAYOUTS[layout](*lightfield.shape),
+                    filters = tables.Filters(complevel = 4, complib = 'zlib'))
+        lfarray[n] = lightfield
+
+    if lfarray is not None:
+        lfarray.attrs.frames = numpy.array([int(i) for (i, node) in frames])
+        lfarray.attrs.offsets_U = offsets
+        lfarray.attrs.offsets_V = offsets
+        print 'lightfield dimensions', lfarray.shape
+    h5file.close()
+    return True
+
+if __name__ == '__main__':
+    filename = sys.argv[1]
+    radius = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    step = float(sys.argv[3]) if len(sys.argv) > 3 else 1.
+    layout = sys.argv[4] if len(sys.argv) > 4 else 'views'
+    if layout not in LAYOUTS:
+        sys.exit("Unknown layout " + layout + ", expected one of " + ", ".join(sorted(LAYOUTS)))
+    if not processFileLightField(filename, radius, step, layout):
+        sys.exit(1)
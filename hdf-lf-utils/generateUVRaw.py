@@ -3,11 +3,43 @@
 # Generate a raw image with the sample view from a certain U,V viewpoint
 # from a lightfield image
 #
-# Usage: ./generateUVRaw.py inputFile outputDir ofs_U ofs_V ["raw"|"png"]
+# Usage: ./generateUVRaw.py [-j JOBS] [-p] [-s] inputFile outputDir [--] ofs_U ofs_V ["raw"|"png"|"npy"|"stack"]
+#
+# ofs_U and ofs_V may also be comma-separated lists of offsets, e.g.
+# -2,-1,0,1,2, to sweep over the grid of all their combinations (or,
+# with -p, over the pairs of the i-th U and i-th V offsets). A list
+# starting with a negative offset would be taken for an option, so
+# put -- before the offsets, e.g.
+#
+#   ./generateUVRaw.py input.hdf5 out/ -- -2,-1,0,1,2 0 png
+#
+# Every frame is read only once for all the viewpoints, and the output
+# of each viewpoint goes to its own outputDir/uv_<ofs_U>_<ofs_V>/
+# directory.
+#
+# The raw and png formats write one file per frame. The npy and stack
+# formats write all frames into a single (frame, y, x) array instead,
+# preallocated and filled in place through numpy.memmap: a .npy file,
+# or a headerless .raw file. Either way, a .json file next to it gives
+# the shape, dtype and frame numbers of the stack, e.g. for
+#
+#   numpy.memmap('file.raw', dtype = h['dtype'], mode = 'r', shape = tuple(h['shape']))
+#
+# With -j, the frames are resampled by a pool of JOBS processes; the
+# output is still written in frame order. Otherwise, the next frames
+# are read and decompressed in the background during the resampling.
+#
+# With -s, the sampling plans of the viewpoints are stored in the
+# /samplingplans group of inputFile (which must be writable), so that
+# later runs over the same file load them instead of building them.
 #
 # FIXME: Generates a PNG image now
 
+import argparse
+import itertools
+import json
 import math
+import multiprocessing
 import os
 import sys
 
@@ -18,9 +50,57 @@ import hdf5lflib
 
 gridsize_last = []
 
-def processFrameUV(i, node, outputBase, ofs_U, ofs_V, ar, cw, imgfmt):
-    uvframe = hdf5lflib.compute_uvframe(node, ar, cw, ofs_U, ofs_V)
+# Output formats writing all frames into a single memory-mapped stack
+STACK_FORMATS = ('npy', 'stack')
+
+# (h5file, ar, cw, planfile) of the file being processed, opened once
+# per process; planfile is the file to load sampling plans from, or None
+h5state = None
+
+def openFileUV(filename, plans = False, mode = "r"):
+    global h5state
+    h5file = tables.open_file(filename, mode = mode)
+    ar = h5file.get_node('/', '/autorectification')
+    try:
+        cw = h5file.get_node('/', '/cropwindow')
+    except tables.NoSuchNodeError:
+        cw = None
+    h5state = (h5file, ar, cw, h5file if plans else None)
+
+def storePlansUV(filename, frame, viewpoints):
+    # Load or build the sampling plans of all viewpoints for the frame
+    # geometry and store the new ones in the file; they stay in the
+    # plan cache of this process
+    openFileUV(filename, True, "a")
+    (h5file, ar, cw, planfile) = h5state
+    imgdata = hdf5lflib.read_frame(h5file.get_node('/images', frame), cw)
+    for (ofs_U, ofs_V) in viewpoints:
+        hdf5lflib.sampling_plan(ar, cw, imgdata.shape, ofs_U, ofs_V, planfile)
+    h5file.close()
+
+def computeFrameUV(job):
+    (i, viewpoints) = job
+    (h5file, ar, cw, planfile) = h5state
+    node = h5file.get_node('/images', i)
+    return (i, hdf5lflib.compute_uvframes(node, ar, cw, viewpoints, planfile))
+
+def prefetchFramesUV(frames, viewpoints):
+    # Resample in this process while the next frames are read ahead;
+    # the plans are not loaded from the file, which the reader thread
+    # is using, but were put in the plan cache by storePlansUV()
+    (h5file, ar, cw, planfile) = h5state
+    ar = hdf5lflib.AttributeSnapshot(ar)
+    if cw is not None:
+        cw = hdf5lflib.AttributeSnapshot(cw)
+    nodes = [(i, h5file.get_node('/images', i)) for i in frames]
+    for (i, imgdata) in hdf5lflib.prefetch_frames(nodes, lambda node: hdf5lflib.read_frame(node, cw)):
+        yield (i, hdf5lflib.resample_uvframes(imgdata, ar, cw, viewpoints))
 
+def offsetList(text):
+    # "-1,0,1" -> [-1., 0., 1.]
+    return [float(ofs) for ofs in text.split(',')]
+
+def processFrameUV(i, uvframe, outputBase, imgfmt):
     global gridsize_last
     gridsize_last = uvframe.shape
 
@@ -31,28 +111,101 @@ def processFrameUV(i, node, outputBase, ofs_U, ofs_V, ar, cw, imgfmt):
         uvframe.tofile(f)
         f.close()
 
-def processFileUV(filename, outputDirectoryPath, ofs_U, ofs_V, imgfmt):
+def openStackUV(outputBase, imgfmt, frames, uvframe):
+    shape = (len(frames),) + uvframe.shape
+    if imgfmt == 'npy':
+        stack = numpy.lib.format.open_memmap(outputBase + '.npy', mode = 'w+', dtype = uvframe.dtype, shape = shape)
+    else:
+        stack = numpy.memmap(outputBase + '.raw', mode = 'w+', dtype = uvframe.dtype, shape = shape)
+    header = {'shape': list(shape), 'dtype': uvframe.dtype.str, 'frames': [int(i) for i in frames]}
+    f = open(outputBase + '.json', 'w')
+    json.dump(header, f)
+    f.close()
+    return stack
+
+def viewpointBase(filename, outputDirectoryPath, viewpoint, sweep):
+    if sweep:
+        outputDirectoryPath += 'uv_%g_%g' % viewpoint + os.sep
+        if not os.path.isdir(outputDirectoryPath):
+            os.makedirs(outputDirectoryPath)
+    return outputDirectoryPath + os.path.splitext(os.path.basename(filename))[0]
+
+def processFileUV(filename, outputDirectoryPath, viewpoints, imgfmt, jobs = 1, plans = False):
     h5file = tables.open_file(filename, mode = "r")
-    ar = h5file.get_node('/', '/autorectification')
-    try:
-        cw = h5file.get_node('/', '/cropwindow')
-    except tables.NoSuchNodeError:
-        cw = None
-    outputBase = outputDirectoryPath + os.path.splitext(os.path.basename(filename))[0]
-    for (i, node) in sorted(h5file.get_node('/', '/images')._v_children.items(), key = lambda j: int(j[0])):
-        print outputBase, i
-        processFrameUV(i, node, outputBase, ofs_U, ofs_V, ar, cw, imgfmt)
+    frames = sorted(h5file.get_node('/', '/images')._v_children.keys(), key = int)
+    h5file.close()
+    outputBases = [viewpointBase(filename, outputDirectoryPath, viewpoint, len(viewpoints) > 1) for viewpoint in viewpoints]
+    frameJobs = [(i, viewpoints) for i in frames]
+    # Keep the sampling plans of all viewpoints around for the next frame
+    hdf5lflib.PLAN_CACHE_SIZE = max(hdf5lflib.PLAN_CACHE_SIZE, len(viewpoints))
+    if plans and frames:
+        storePlansUV(filename, frames[0], viewpoints)
+
+    if jobs > 1:
+        # Every worker opens the file and reads its metadata once
+        pool = multiprocessing.Pool(jobs, openFileUV, (filename, plans))
+        results = pool.imap(computeFrameUV, frameJobs)
+    else:
+        pool = None
+        openFileUV(filename)
+        results = prefetchFramesUV(frames, viewpoints)
+
+    global gridsize_last
+    stacks = [None] * len(viewpoints)
+    for (n, (i, uvframes)) in enumerate(results):
+        print outputBases[0], i
+        for (v, (outputBase, uvframe)) in enumerate(zip(outputBases, uvframes)):
+            if imgfmt in STACK_FORMATS:
+                if stacks[v] is None:
+                    stacks[v] = openStackUV(outputBase, imgfmt, frames, uvframe)
+                stacks[v][n] = uvframe
+                gridsize_last = uvframe.shape
+            else:
+                processFrameUV(i, uvframe, outputBase, imgfmt)
+    for stack in stacks:
+        if stack is not None:
+            stack.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        h5state[0].close()
     return True
 
 if __name__ == '__main__':
-    filename = sys.argv[1]
-    outputDirectoryPath = os.path.normpath(sys.argv[2]) + os.sep
-    ofs_U = sys.argv[3]
-    ofs_V = sys.argv[4]
-    if sys.argv[5]:
-        imgfmt = sys.argv[5]
+    parser = argparse.ArgumentParser(
+        prog='generateUVRaw.py',
+        description='Generates the views from a U,V viewpoint of all frames of a lightfield image')
+    parser.add_argument("inputFile", type=str)
+    parser.add_argument("outputDir", type=str)
+    parser.add_argument("ofs_U", type=offsetList,
+        help="""U offset or comma-separated list of offsets; put -- before a list starting with a negative offset""")
+    parser.add_argument("ofs_V", type=offsetList,
+        help="""V offset or comma-separated list of offsets""")
+    parser.add_argument("imgfmt", nargs='?', choices=('raw', 'png') + STACK_FORMATS, default='raw')
+    parser.add_argument('-j',
+        '--jobs',
+        help="""Number of frames resampled concurrently (default: 1)""",
+        type=int,
+        default=1)
+    parser.add_argument('-p',
+        '--pairs',
+        help="""Pair up the i-th U and V offsets instead of sweeping over their grid""",
+        action="store_true")
+    parser.add_argument('-s',
+        '--store-plans',
+        help="""Store the sampling plans in the input file for later runs""",
+        action="store_true")
+    args = parser.parse_args()
+
+    if args.pairs:
+        if len(args.ofs_U) != len(args.ofs_V):
+            parser.error("-p needs as many U offsets as V offsets")
+        viewpoints = zip(args.ofs_U, args.ofs_V)
     else:
-        imgfmt = 'raw'
-    if not processFileUV(filename, outputDirectoryPath, float(ofs_U), float(ofs_V), imgfmt):
+        viewpoints = list(itertools.product(args.ofs_U, args.ofs_V))
+    outputDirectoryPath = os.path.normpath(args.outputDir) + os.sep
+    if not processFileUV(args.inputFile, outputDirectoryPath, viewpoints, args.imgfmt, args.jobs, args.store_plans):
         sys.exit(1)
     print 'output dimensions', gridsize_last
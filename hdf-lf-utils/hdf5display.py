@@ -13,6 +13,7 @@
 import sys
 
 import tables
+import hdf5lflib
 
 import matplotlib.pyplot as plt
 import matplotlib.patches
@@ -23,15 +24,15 @@ GAIN_LEVEL = 8.
 
 filename = sys.argv[1]
 
-for objpath in sys.argv[2:]:
-    h5file = tables.open_file(filename, mode = "r")
-    try:
-        cw = h5file.get_node('/', '/cropwindow')
-    except tables.NoSuchNodeError:
-        cw = None
+h5file = tables.open_file(filename, mode = "r")
+try:
+    cw = hdf5lflib.AttributeSnapshot(h5file.get_node('/', '/cropwindow'))
+except tables.NoSuchNodeError:
+    cw = None
 
-    node = h5file.get_node('/', objpath)
-    data = node.read()
+# The next frames are read while the current one is being plotted
+nodes = [(objpath, h5file.get_node('/', objpath)) for objpath in sys.argv[2:]]
+for (objpath, data) in hdf5lflib.prefetch_frames(nodes, lambda node: node.read()):
     data *= GAIN_LEVEL
 
     f, axes = plt.subplots(ncols = 2)
@@ -3,6 +3,11 @@
 
 import numpy
 import math
+import collections
+import hashlib
+import sys
+import threading
+import Queue
 
 def compute_maxu(imageGroup):
     """
@@ -32,28 +37,22 @@ def compute_maxu(imageGroup):
 
 def lenslets_offset2corner(ar, corner):
     """
-    Walk from the lenslets offset point to the point of the grid
-    nearest to the top left corner.
-    """
-    changed = True
-    while changed:
-        changed = False
-        if corner[1] > corner[0] and corner[0] > ar._v_attrs['down_dy'] and corner[1] > ar._v_attrs['down_dx']:
-            corner[0] -= ar._v_attrs['down_dy']
-            corner[1] -= ar._v_attrs['down_dx']
-            changed = True
-        if corner[0] > ar._v_attrs['right_dy'] and corner[1] > ar._v_attrs['right_dx']:
-            corner[0] -= ar._v_attrs['right_dy']
-            corner[1] -= ar._v_attrs['right_dx']
-            changed = True
-        if corner[1] > corner[0] and corner[0] > ar._v_attrs['down_dy'] and corner[1] > ar._v_attrs['down_dx']:
-            corner[0] -= ar._v_attrs['down_dy']
-            corner[1] -= ar._v_attrs['down_dx']
-            changed = True
-    # FIXME: Note that we might get stuck at a point where we e.g. still have
-    # some room to go many steps up at the cost of going one step right.
-
-    return corner
+    Find the point of the lens grid through the lenslets offset point
+    @corner nearest to the top left corner, among the grid points
+    with no negative coordinates. Works for tilted grids as well.
+    """
+    right = numpy.array([ar._v_attrs['right_dy'], ar._v_attrs['right_dx']], dtype = float)
+    down = numpy.array([ar._v_attrs['down_dy'], ar._v_attrs['down_dx']], dtype = float)
+    # Whole grid steps (a, b) from the origin to the offset point; the
+    # grid points nearest to the origin are among the few around the
+    # one a steps right and b steps down of it.
+    (a, b) = numpy.floor(numpy.linalg.solve(numpy.array([right, down]).T, corner) + 1e-9)
+    steps = numpy.array([(i, j) for i in range(-1, 3) for j in range(-1, 3)])
+    points = numpy.asarray(corner, dtype = float) - (a - steps[:, :1]) * right - (b - steps[:, 1:]) * down
+    points[numpy.abs(points) < 1e-9] = 0.
+    points = points[(points >= 0).all(axis = 1)]
+    nearest = points[numpy.argmin((points ** 2).sum(axis = 1))]
+    return [nearest[0], nearest[1]]
 
 def pointInterpolate(imgdata, point):
     """
@@ -68,43 +67,307 @@ def pointInterpolate(imgdata, point):
     return value
 
 
-def compute_uvframe(node, ar, cw, ofs_U = 0., ofs_V = 0.):
+def lenslet_centers(ar, corner, gridsize, ofs_U = 0., ofs_V = 0.):
     """
-    Generate a view of the sample from a particular (U,V) viewpoint
-    from the lightsheet data (as stored in HDF5 @node). The view
-    is returned as a numpy 2D array.
+    Compute image coordinates of the (U,V) viewpoint in all lenses
+    of a grid of gridsize[0] x gridsize[1] lenses whose first lens
+    is at @corner (as returned by lenslets_offset2corner()).
+    Returns a tuple (cy, cx) of 2D arrays indexed by lens grid [y, x].
+    """
+    (right_dx, right_dy) = ar._v_attrs['right_dx'], ar._v_attrs['right_dy']
+    (down_dx, down_dy) = ar._v_attrs['down_dx'], ar._v_attrs['down_dy']
+    ys = numpy.arange(gridsize[0]).reshape(-1, 1)
+    xs = numpy.arange(gridsize[1]).reshape(1, -1)
+    cx = corner[1] + xs * right_dx + ys * down_dx + ofs_U
+    cy = corner[0] + xs * right_dy + ys * down_dy + ofs_V
+    return (cy, cx)
+
+def bilinear_neighbors(shape, cy, cx):
+    """
+    Set up 2x2 interpolation at all the points given by coordinate
+    arrays @cy, @cx within an image of @shape. Returns a tuple
+    (iy, ix, weights, valid): the coordinates of the four neighbors
+    of each point and their weights, stacked along a new first axis,
+    and the mask of points whose 2x2 neighborhood lies within the
+    image. Invalid points refer to pixel [0, 0] with zero weights.
+    """
+    y0 = numpy.floor(cy)
+    x0 = numpy.floor(cx)
+    y1 = numpy.ceil(cy)
+    x1 = numpy.ceil(cx)
+    valid = (y0 >= 0) & (x0 >= 0) & (y1 < shape[0]) & (x1 < shape[1])
+
+    iy = numpy.where(valid, [y0, y0, y1, y1], 0).astype(numpy.int32)
+    ix = numpy.where(valid, [x0, x1, x0, x1], 0).astype(numpy.int32)
+    beta_y = y1 - cy
+    beta_x = x1 - cx
+    weights = numpy.array([beta_y * beta_x,
+                           beta_y * (1.-beta_x),
+                           (1.-beta_y) * beta_x,
+                           (1.-beta_y) * (1.-beta_x)])
+    weights[:, ~valid] = 0.
+    return (iy, ix, weights, valid)
+
+
+def read_frame(node, cw):
+    """
+    Read the lightfield frame stored in HDF5 @node, crop it by the
+    crop window @cw (None for no cropping) and transpose it.
     """
 
     # We also rotate the image by 90\deg during the processing to maintain
     # compatibility with other parts of our toolchain.
 
-    imgdata = node.read()
+    if cw is not None:
+        # Read only the crop window hyperslab, so that chunks outside
+        # of it are not decompressed at all
+        (x0, y0, x1, y1) = (int(cw._v_attrs[j]) for j in ('x0', 'y0', 'x1', 'y1'))
+        imgdata = node[y0:y1 , x0:x1]
+    else:
+        imgdata = node.read()
     # scipy.misc.imsave('rawimage.png', imgdata)
 
-    (right_dx, right_dy) = ar._v_attrs['right_dx'], ar._v_attrs['right_dy']
-    (down_dx, down_dy) = ar._v_attrs['down_dx'], ar._v_attrs['down_dy']
+    # Before we interpret autorectification, we need to transpose the image
+    return numpy.swapaxes(imgdata, 0, 1)
+
+def frame_lattice(ar, cw, shape):
+    """
+    Determine the lens grid of a frame of @shape as returned by
+    read_frame(). Returns a tuple (corner, gridsize) with the image
+    coordinates of the first lens and the number of lens rows and
+    columns.
+    """
     corner = [ar._v_attrs['y_offset'], ar._v_attrs['x_offset']]
     if cw is not None:
-        (x0, y0, x1, y1) = (cw._v_attrs[j] for j in ('x0', 'y0', 'x1', 'y1'))
-        imgdata = imgdata[y0:y1 , x0:x1]
+        (x0, y0) = (cw._v_attrs['x0'], cw._v_attrs['y0'])
         corner = [corner[0] - x0, corner[1] - y0]
+    corner = lenslets_offset2corner(ar, corner)
+    gridsize = (int(math.floor(shape[0] / ar._v_attrs['down_dy'])), int(math.floor(shape[1] / ar._v_attrs['right_dx'])))
+    return (corner, gridsize)
 
-    # Before we interpret autorectification, we need to transpose the image
-    imgdata = numpy.swapaxes(imgdata, 0, 1)
 
-    corner = lenslets_offset2corner(ar, corner)
-    gridsize = (int(math.floor(imgdata.shape[0] / ar._v_attrs['down_dy'])), int(math.floor(imgdata.shape[1] / ar._v_attrs['right_dx'])))
+class SamplingPlan:
+    """
+    Precomputed resampling of frames to a single (U,V) view: for
+    every pixel of the view, the coordinates of the four frame pixels
+    it is interpolated from and their bilinear weights. The arrays
+    are laid out in output order (lens grid flipped vertically), so
+    applying the plan is a single gather and a weighted sum.
+    """
+    def __init__(self, iy, ix, weights):
+        self.iy = iy
+        self.ix = ix
+        self.weights = weights
+        self.shape = weights.shape[1:]
+
+    @classmethod
+    def build(cls, ar, corner, gridsize, shape, ofs_U = 0., ofs_V = 0.):
+        """
+        Compute the plan for frames of @shape with the lens grid given
+        by @corner and @gridsize (see frame_lattice()). Lenses reaching
+        out of the image get zero weights and come out black.
+        """
+        (cy, cx) = lenslet_centers(ar, corner, gridsize, ofs_U, ofs_V)
+        (iy, ix, weights, valid) = bilinear_neighbors(shape, cy, cx)
+        flip = lambda a: numpy.ascontiguousarray(a[:, ::-1])
+        return cls(flip(iy), flip(ix), flip(weights))
+
+    def apply(self, imgdata):
+        """
+        Generate the (U,V) view from a frame as returned by read_frame().
+        """
+        products = self.weights * imgdata[self.iy, self.ix]
+        return (products[0] + products[1] + products[2] + products[3]).astype('short')
+
+
+# Most recently used sampling plans, by plan_key()
+PLAN_CACHE_SIZE = 64
+_plan_cache = collections.OrderedDict()
+
+# HDF5 group where sampling_plan() persists plans
+PLAN_GROUP = '/samplingplans'
+
+def plan_key(ar, cw, shape, ofs_U = 0., ofs_V = 0.):
+    """
+    Return the hashable key identifying the sampling plan of frames
+    of @shape (as returned by read_frame()) for the given
+    autorectification, crop window and (U,V) viewpoint.
+    """
+    rectification = tuple(float(ar._v_attrs[j]) for j in
+                          ('x_offset', 'y_offset', 'right_dx', 'right_dy', 'down_dx', 'down_dy'))
+    if cw is not None:
+        cropwindow = tuple(int(cw._v_attrs[j]) for j in ('x0', 'y0', 'x1', 'y1'))
+    else:
+        cropwindow = None
+    return (rectification, cropwindow, tuple(shape), float(ofs_U), float(ofs_V))
+
+def load_sampling_plan(h5file, key):
+    """
+    Load the sampling plan stored under @key in the open tables file
+    @h5file; returns None if there is none.
+    """
+    name = PLAN_GROUP + '/plan_' + hashlib.sha1(repr(key)).hexdigest()[:16]
+    if name not in h5file:
+        return None
+    group = h5file.get_node(name)
+    if group._v_attrs['key'] != repr(key):
+        return None
+    return SamplingPlan(group.iy.read(), group.ix.read(), group.weights.read())
+
+def store_sampling_plan(h5file, key, plan):
+    """
+    Persist @plan under @key in the tables file @h5file (opened
+    for writing), so that later runs need not build it again.
+    """
+    name = 'plan_' + hashlib.sha1(repr(key)).hexdigest()[:16]
+    if PLAN_GROUP not in h5file:
+        h5file.create_group('/', PLAN_GROUP.lstrip('/'))
+    if PLAN_GROUP + '/' + name in h5file:
+        h5file.remove_node(PLAN_GROUP, name, recursive = True)
+    group = h5file.create_group(PLAN_GROUP, name)
+    group._v_attrs['key'] = repr(key)
+    for (arrayname, array) in (('iy', plan.iy), ('ix', plan.ix), ('weights', plan.weights)):
+        h5file.create_array(group, arrayname, array)
 
-    uvframe = numpy.zeros(shape=(gridsize[0], gridsize[1]), dtype='short')
+def sampling_plan(ar, cw, shape, ofs_U = 0., ofs_V = 0., h5file = None):
+    """
+    Return the sampling plan for frames of @shape (as returned by
+    read_frame()) for the given autorectification, crop window and
+    (U,V) viewpoint. Plans are kept in an LRU cache of PLAN_CACHE_SIZE
+    entries. If @h5file is given, plans are also looked up there and,
+    if the file is writable, newly built plans are stored in it.
+    """
+    key = plan_key(ar, cw, shape, ofs_U, ofs_V)
+    plan = _plan_cache.pop(key, None)
+    if plan is None and h5file is not None:
+        plan = load_sampling_plan(h5file, key)
+    if plan is None:
+        (corner, gridsize) = frame_lattice(ar, cw, shape)
+        plan = SamplingPlan.build(ar, corner, gridsize, shape, ofs_U, ofs_V)
+        if h5file is not None and h5file.mode != 'r':
+            store_sampling_plan(h5file, key, plan)
+    _plan_cache[key] = plan
+    while len(_plan_cache) > PLAN_CACHE_SIZE:
+        _plan_cache.popitem(last = False)
+    return plan
+
+
+def compute_uvframe(node, ar, cw, ofs_U = 0., ofs_V = 0., h5file = None):
+    """
+    Generate a view of the sample from a particular (U,V) viewpoint
+    from the lightsheet data (as stored in HDF5 @node). The view
+    is returned as a numpy 2D array. The sampling plan is shared
+    by all frames of the same geometry, see sampling_plan().
+    """
+    imgdata = read_frame(node, cw)
+    return sampling_plan(ar, cw, imgdata.shape, ofs_U, ofs_V, h5file).apply(imgdata)
+
+def compute_uvframes(node, ar, cw, viewpoints, h5file = None):
+    """
+    Generate the views from all the (ofs_U, ofs_V) @viewpoints of the
+    lightsheet data stored in HDF5 @node, reading the frame only once.
+    Returns a list of numpy 2D arrays, as compute_uvframe() would
+    produce them.
+    """
+    return resample_uvframes(read_frame(node, cw), ar, cw, viewpoints, h5file)
+
+def resample_uvframes(imgdata, ar, cw, viewpoints, h5file = None):
+    """
+    Like compute_uvframes(), for a frame already returned by read_frame().
+    """
+    return [sampling_plan(ar, cw, imgdata.shape, ofs_U, ofs_V, h5file).apply(imgdata)
+            for (ofs_U, ofs_V) in viewpoints]
 
-    for y in range(int(gridsize[0])):
-        for x in range(int(gridsize[1])):
-            cx = corner[1] + x * right_dx + y * down_dx + ofs_U
-            cy = corner[0] + x * right_dy + y * down_dy + ofs_V
+
+def uv_offsets(radius, step = 1.):
+    """
+    Return the (U or V) viewpoint offsets from -@radius to @radius
+    (inclusive) in @step increments, as a numpy array.
+    """
+    return numpy.arange(-radius, radius + step / 2., step)
+
+def compute_lightfield(node, ar, cw, offsets_U, offsets_V, h5file = None):
+    """
+    Resample the lightfield frame stored in HDF5 @node to a 4D
+    (u, v, s, t) numpy array: [i, j] is the view from viewpoint
+    (offsets_U[i], offsets_V[j]), as compute_uvframe() would produce
+    it. The frame is read only once. To reuse the sampling plans
+    for the next frame, PLAN_CACHE_SIZE should be at least the
+    number of views.
+    """
+    imgdata = read_frame(node, cw)
+    lightfield = None
+    for (i, ofs_U) in enumerate(offsets_U):
+        for (j, ofs_V) in enumerate(offsets_V):
+            view = sampling_plan(ar, cw, imgdata.shape, ofs_U, ofs_V, h5file).apply(imgdata)
+            if lightfield is None:
+                lightfield = numpy.zeros(shape=(len(offsets_U), len(offsets_V)) + view.shape, dtype='short')
+            lightfield[i, j] = view
+    return lightfield
+
+
+class AttributeSnapshot:
+    """
+    In-memory copy of the user attributes of HDF5 @node (e.g. the
+    autorectification or cropwindow group), which the functions
+    here accept in place of the node. Unlike the node, it can be
+    used while another thread reads the file, and can be pickled.
+    """
+    def __init__(self, node):
+        attrs = node._v_attrs
+        self._v_attrs = dict((name, attrs[name]) for name in attrs._f_list('user'))
+
+# Number of frames prefetch_frames() reads ahead by default
+PREFETCH_DEPTH = 4
+
+def prefetch_frames(frames, read, depth = PREFETCH_DEPTH):
+    """
+    Iterate over the (name, node) @frames (e.g. the sorted children
+    of the /images group), yielding (name, read(node)) in the same
+    order, while a background thread runs read() up to @depth frames
+    ahead; reading and decompressing the next frames thus overlaps
+    with the processing of the current one. At most @depth + 2 frames
+    are held in memory. Exceptions of read() are raised in the caller.
+
+    HDF5 files must not be accessed concurrently, so while iterating,
+    the caller must only use the data yielded (and, instead of
+    attribute nodes, AttributeSnapshot).
+    """
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up once the caller has stopped iterating
+        while not stop.is_set():
             try:
-                uvframe[gridsize[0]-1 - y][x] = pointInterpolate(imgdata, [cy, cx])
-                # print 'src', [cy, cx], 'dst', [gridsize[0]-1 - y, x], ' := ', uvframe[gridsize[0]-1 - y][x]
-            except IndexError:
+                queue.put(item, timeout = 0.1)
+                return True
+            except Queue.Full:
                 pass
+        return False
+
+    def reader():
+        for (name, node) in frames:
+            try:
+                item = (name, read(node), None)
+            except Exception:
+                item = (name, None, sys.exc_info())
+            if not put(item) or item[2] is not None:
+                return
+        put(None)
 
-    return uvframe
+    thread = threading.Thread(target = reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            (name, data, error) = item
+            if error is not None:
+                raise error[0], error[1], error[2]
+            yield (name, data)
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,40 @@
+import unittest
+
+import numpy
+import hdf5refocus
+
+
+def smooth_lightfield(views, shape, depth, seed = 0):
+    """
+    Lightfield of a smooth random scene at the given @depth, with
+    (views, views) viewpoints at whole offsets around 0.
+    """
+    rng = numpy.random.RandomState(seed)
+    ks = numpy.fft.fftfreq(shape[0]).reshape(-1, 1)
+    kt = numpy.fft.fftfreq(shape[1]).reshape(1, -1)
+    lowpass = numpy.exp(-(ks ** 2 + kt ** 2) / (2. * 0.08 ** 2))
+    scene = numpy.fft.ifft2(numpy.fft.fft2(rng.rand(*shape) * 1000.) * lowpass).real
+    offsets = numpy.arange(views) - views // 2.
+    lightfield = numpy.array([[hdf5refocus.shift_view(scene, depth * ofs_V, depth * ofs_U)
+                               for ofs_V in offsets] for ofs_U in offsets])
+    return (lightfield, offsets)
+
+
+class FocalStackTest(unittest.TestCase):
+    def test_matches_shift_and_add(self):
+        (lightfield, offsets) = smooth_lightfield(9, (64, 72), 1.3)
+        alphas = numpy.linspace(-2.5, 2.5, 11)
+        stack = hdf5refocus.focal_stack(lightfield, offsets, offsets, alphas)
+        reference = hdf5refocus.focal_stack_shift_and_add(lightfield, offsets, offsets, alphas)
+        error = numpy.abs(stack - reference) / (reference.max() - reference.min())
+        self.assertLess(error.mean(), 0.005)
+        self.assertLess(error.max(), 0.03)
+
+    def test_in_focus_is_mean_view(self):
+        (lightfield, offsets) = smooth_lightfield(5, (32, 40), 0.5, seed = 1)
+        image = hdf5refocus.FourierRefocuser(lightfield, offsets, offsets).refocus(0.)
+        numpy.testing.assert_allclose(image, lightfield.mean(axis = (0, 1)), atol = 1e-2)
+
+
+if __name__ == '__main__':
+    unittest.main()